@@ -0,0 +1,188 @@
+"""
+Request scoped deduplication of form renders. While it is on in the current thread,
+`uni_form.middleware.RenderDedupMiddleware` turns it on per request, rendering again
+the same form instance with an equivalent helper and the same context inputs returns
+the earlier output. DOM ids and label `for` attributes are suffixed with the number of
+the render, `_2`, `_3`..., so they stay unique in the page.
+
+Helpers are equivalent when their descriptors, see `uni_form.serializers`, are the
+same, or when they are the same object. Context inputs are the CSRF token, the template
+pack and the variables used by the layout `HTML` contents, `Fieldset` legends and
+`Deferred` labels, and by the templates of the render: the form templates, with the
+ones they include, the field templates and the layout objects ones, custom `template`
+included. Layouts holding `Conditional` objects, renders using snippets or templates
+that can't be analysed and formsets rendered with `FormHelper.render_empty_form` are
+always rendered.
+"""
+import re
+import threading
+
+from django.conf import settings
+from django.forms.formsets import BaseFormSet
+from django.template.defaulttags import CsrfTokenNode
+from django.template.loader_tags import ConstantIncludeNode
+from django.utils.safestring import mark_safe
+
+from uni_form.layout import Conditional, Deferred, Fieldset, HTML
+from uni_form.serializers import SerializationError, dumps_helper
+from uni_form.utils import get_pack_template, get_snippet, get_template_lookups, get_template_pack
+
+
+ids_re = re.compile(r'''(\s(?:id|for)=["'])([^"']+)(["'])''')
+
+_local = threading.local()
+
+# Context variable names used by pack templates, by pack and template name
+template_names = {}
+
+
+def start():
+    """
+    Deduplicates renders in the current thread from now on, until `stop` is called.
+    """
+    _local.renders = []
+
+def stop():
+    _local.renders = None
+
+def is_on():
+    return getattr(_local, 'renders', None) is not None
+
+def get_template_names(template_name, context):
+    """
+    Returns the names of the context variables the template of the template pack in use
+    for `template_name` uses, with the templates it includes, or None if they can't be
+    known. Results are kept unless in DEBUG mode.
+    """
+    # Imported here, the tags module imports this one
+    from uni_form.templatetags.uni_form_tags import PackIncludeNode
+
+    key = (get_template_pack(context), template_name)
+    if not settings.DEBUG:
+        try:
+            return template_names[key]
+        except KeyError:
+            pass
+
+    seen = set()
+    def follow(node):
+        if isinstance(node, CsrfTokenNode):
+            return []
+        if isinstance(node, ConstantIncludeNode):
+            if node.template is None or node.template in seen:
+                return node.extra_context.values()
+            seen.add(node.template)
+            return [node.extra_context.values(), node.template.nodelist]
+        if isinstance(node, PackIncludeNode):
+            template = get_pack_template(node.template_name, context)
+            if template in seen:
+                return []
+            seen.add(template)
+            return template.nodelist
+        return None
+
+    template = get_pack_template(template_name, context)
+    seen.add(template)
+    lookups = get_template_lookups(template.nodelist, follow)
+    names = None
+    if lookups is not None:
+        names = frozenset([bits[0] for bits in lookups[0]])
+    template_names[key] = names
+    return names
+
+def get_context_names(layout, context):
+    """
+    Returns the names of the context variables `layout` snippets and templates use, or
+    None if they can't be known.
+    """
+    names = set()
+    nodes = [layout]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, Conditional):
+            return None
+        template_name = getattr(node, 'template', None)
+        if isinstance(template_name, basestring):
+            node_names = get_template_names(template_name, context)
+            if node_names is None:
+                return None
+            names.update(node_names)
+        source = None
+        if isinstance(node, HTML):
+            source = node.html
+        elif isinstance(node, Fieldset):
+            source = node.legend
+        elif isinstance(node, Deferred):
+            source = node.label
+        if source:
+            lookups = get_template_lookups(get_snippet(source).template.nodelist)
+            if lookups is None:
+                return None
+            names.update([bits[0] for bits in lookups[0]])
+        nodes.extend([field for field in getattr(node, 'fields', ()) if not isinstance(field, basestring)])
+    return names
+
+def get_key(form, helper, context):
+    """
+    Returns the key identifying a render of `form` with `helper` in `context`, or None
+    if deduplication is off or the render can't be deduplicated. `context` is None for
+    renders that don't use the template context, like the `as_uni_form` filter ones.
+    """
+    if not is_on():
+        return None
+
+    # The add form buttons of a repeat would clone the empty form and update the
+    # management form of the first render, found by their ids
+    is_formset = isinstance(form, BaseFormSet)
+    if is_formset and helper is not None and helper.render_empty_form:
+        return None
+
+    helper_key = None
+    if helper is not None:
+        try:
+            helper_key = dumps_helper(helper)
+        except SerializationError:
+            helper_key = helper
+    if context is None:
+        return (form, helper_key)
+
+    pack_context = context
+    if helper is not None and helper.template_pack:
+        pack_context = {'uni_form_template_pack': helper.template_pack}
+
+    if is_formset:
+        template_name = 'uni_form/whole_uni_formset.html'
+    else:
+        template_name = 'uni_form/whole_uni_form.html'
+    names = get_template_names(template_name, pack_context)
+    if names is None:
+        return None
+    names = set(names).union(['csrf_token', 'uni_form_template_pack'])
+
+    if helper is not None and helper.layout is not None:
+        layout_names = get_context_names(helper.layout, pack_context)
+        if layout_names is None:
+            return None
+        names.update(layout_names)
+        for template_name in ('uni_form/field.html', 'uni_form/multifield.html'):
+            field_names = get_template_names(template_name, pack_context)
+            if field_names is None:
+                return None
+            names.update(field_names)
+
+    names = sorted(names)
+    return (form, helper_key, names, [context.get(name) for name in names])
+
+def get(key):
+    """
+    Returns the output of the earlier render with `key`, with its DOM ids made unique,
+    or None if there is none.
+    """
+    for entry in _local.renders:
+        if entry[0] == key:
+            entry[2] += 1
+            return mark_safe(ids_re.sub(r'\g<1>\g<2>_%d\g<3>' % entry[2], entry[1]))
+    return None
+
+def add(key, html):
+    _local.renders.append([key, html, 1])
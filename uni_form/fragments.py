@@ -0,0 +1,429 @@
+"""
+Fragment stores, where django-uni-form keeps rendered output it reuses between renders,
+like the partially rendered field templates of `uni_form.utils.render_field_template`.
+
+The store in use is set in `UNIFORM_FRAGMENT_STORE`, the dotted path of a store class
+instantiated without arguments, or a store instance. By default it is a `FragmentStore`,
+held by every process. `MappedFragmentStore` is shared by every process on the box.
+Stores implement::
+
+    get(key)         # Returns the fragment, or None
+    set(key, value)  # Stores a unicode fragment, or a tuple of unicode segments
+    clear()
+    stats()          # Returns a dictionary of counters
+
+Keys are strings, numbers, booleans, None, classes and tuples of them.
+"""
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import types
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FragmentStore(object):
+    """
+    In-process fragment store, bounded by the memory the fragments it holds take
+    instead of their number. When `max_bytes` are exceeded, the least recently used
+    fragments are evicted. Fragments of `compress_threshold` bytes or more in UTF-8 are
+    kept zlib compressed, 0 disables compression. Tuples of segments are kept as they
+    are, so they are ready to use.
+
+    Defaults to `UNIFORM_FRAGMENT_STORE_MAX_BYTES`, 4MB, and
+    `UNIFORM_FRAGMENT_STORE_COMPRESS_THRESHOLD`, 2KB. It is thread safe.
+    """
+    def __init__(self, max_bytes=None, compress_threshold=None):
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'UNIFORM_FRAGMENT_STORE_MAX_BYTES', 4 * 1024 * 1024)
+        if compress_threshold is None:
+            compress_threshold = getattr(settings, 'UNIFORM_FRAGMENT_STORE_COMPRESS_THRESHOLD', 2048)
+        self.max_bytes = max_bytes
+        self.compress_threshold = compress_threshold
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # Entries are [previous, next, key, data, size, compressed], linked in least
+            # recently used order from the root
+            self.entries = {}
+            self.root = root = []
+            root[:] = [root, root, None, None, 0, False]
+            self.bytes = 0
+            self.hits = self.misses = self.evictions = self.compressed = 0
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            previous, next = entry[0], entry[1]
+            previous[1], next[0] = next, previous
+            last = self.root[0]
+            entry[0], entry[1] = last, self.root
+            last[1] = self.root[0] = entry
+            data, compressed = entry[3], entry[5]
+        finally:
+            self.lock.release()
+
+        if compressed:
+            return zlib.decompress(data).decode('utf-8')
+        return data
+
+    def set(self, key, value):
+        data, compressed = value, False
+        if isinstance(value, tuple):
+            size = sys.getsizeof(value) + sum([sys.getsizeof(segment) for segment in value])
+        else:
+            if self.compress_threshold:
+                encoded = value.encode('utf-8')
+                if len(encoded) >= self.compress_threshold:
+                    data, compressed = zlib.compress(encoded), True
+            size = sys.getsizeof(data)
+        if size > self.max_bytes:
+            return
+
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.remove(self.entries[key])
+            while self.bytes + size > self.max_bytes:
+                self.remove(self.root[1])
+                self.evictions += 1
+
+            last = self.root[0]
+            entry = [last, self.root, key, data, size, compressed]
+            last[1] = self.root[0] = self.entries[key] = entry
+            self.bytes += size
+            self.compressed += compressed
+        finally:
+            self.lock.release()
+
+    def remove(self, entry):
+        previous, next, key, data, size, compressed = entry
+        previous[1], next[0] = next, previous
+        del self.entries[key]
+        self.bytes -= size
+        self.compressed -= compressed
+
+    def stats(self):
+        """
+        Returns a dictionary with `hits`, `misses`, `evictions`, `entries`, `compressed`
+        entries and `bytes` of memory held.
+        """
+        self.lock.acquire()
+        try:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'compressed': self.compressed,
+                'bytes': self.bytes,
+            }
+        finally:
+            self.lock.release()
+
+
+# File layout of `MappedFragmentStore`: a header, an index of `slots` slots and the data
+# region, where records are appended. Slots hold the hash of a key and the offset of its
+# record, 0 when they are empty. Records hold the MD5 digest of the key, the lengths of the
+# key and the fragment, its flags, the key as returned by `get_key_text` and the fragment
+# in UTF-8. Tuples of segments are stored as the length of every segment followed by the
+# segment.
+MAPPED_STORE_MAGIC = 'UFFS'
+MAPPED_STORE_VERSION = 3
+HEADER = struct.Struct('<4sI16sQQIIQI')
+HEADER_SIZE = 64
+SLOT = struct.Struct('<QQ')
+RECORD = struct.Struct('<16sIIB')
+SEGMENT = struct.Struct('<I')
+# Record flags
+COMPRESSED_FLAG, SEGMENTS_FLAG = 1, 2
+# Header fields, by position
+EPOCH, DATA_END, ENTRIES, COMPRESSED, EVICTIONS = 3, 4, 5, 6, 7
+
+
+class MappedFragmentStore(object):
+    """
+    Fragment store backed by a memory mapped file, shared by every process on the box
+    using the same `path`, like pre-forked workers. Fragments stored by any of them are
+    read by the others straight from the shared pages.
+
+    Fragments are appended to the data region of the file, `max_bytes` long, and found
+    through a hash index. When either is full, the whole store is emptied. The store is
+    also emptied when a process opens it with a different `generation`, so setting it to
+    your release identifier invalidates fragments on deploy. Processes of an older
+    generation stop reading and writing fragments.
+
+    Writes are serialized with a lock on the file, while reads take no locks: an epoch
+    counter in the header, changed whenever the store is emptied, tells readers to
+    discard what they read meanwhile.
+
+    Defaults to `UNIFORM_FRAGMENT_STORE_PATH`, a file in the temporary directory named
+    after the settings module, `UNIFORM_FRAGMENT_STORE_MAX_BYTES`, 64MB,
+    `UNIFORM_FRAGMENT_STORE_COMPRESS_THRESHOLD`, 2KB and
+    `UNIFORM_FRAGMENT_STORE_GENERATION`. Every process has to use the same `max_bytes`,
+    opening a file created with another one raises `ImproperlyConfigured`, as resizing it
+    would crash the processes using it. It needs `fcntl`, so it is not available on Windows.
+    """
+    def __init__(self, path=None, max_bytes=None, compress_threshold=None, generation=None):
+        if fcntl is None:
+            raise ImproperlyConfigured("MappedFragmentStore needs the fcntl module")
+        if path is None:
+            path = getattr(settings, 'UNIFORM_FRAGMENT_STORE_PATH', None) or os.path.join(
+                tempfile.gettempdir(), 'uni_form-%s.fragments' % settings.SETTINGS_MODULE)
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'UNIFORM_FRAGMENT_STORE_MAX_BYTES', 64 * 1024 * 1024)
+        if compress_threshold is None:
+            compress_threshold = getattr(settings, 'UNIFORM_FRAGMENT_STORE_COMPRESS_THRESHOLD', 2048)
+        if generation is None:
+            generation = getattr(settings, 'UNIFORM_FRAGMENT_STORE_GENERATION', '')
+        self.path = path
+        self.compress_threshold = compress_threshold
+        self.generation = md5_constructor('%d:%s' % (MAPPED_STORE_VERSION, smart_str(generation))).digest()
+        self.slots = max(64, max_bytes // 256)
+        self.data_start = HEADER_SIZE + self.slots * SLOT.size
+        self.size = self.data_start + max_bytes
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self.acquire()
+        try:
+            # Resizing the file would crash the processes that have it mapped
+            size = os.fstat(self.fd).st_size
+            if not size:
+                os.ftruncate(self.fd, self.size)
+            if size in (0, self.size):
+                self.map = mmap.mmap(self.fd, self.size)
+                header = HEADER.unpack_from(self.map, 0)
+                if header[:3] != (MAPPED_STORE_MAGIC, MAPPED_STORE_VERSION, self.generation) or header[8] != self.slots:
+                    self.reset(header[EPOCH] + 1)
+        finally:
+            self.release()
+
+        if size not in (0, self.size):
+            os.close(self.fd)
+            raise ImproperlyConfigured("Fragment store %s was created with a different max_bytes, "
+                "use another path" % path)
+
+    def acquire(self):
+        self.lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def reset(self, epoch, evictions=0):
+        """
+        Empties the store. It has to be called holding the lock, with an odd `epoch` so
+        that readers discard what they read meanwhile.
+        """
+        HEADER.pack_into(self.map, 0, MAPPED_STORE_MAGIC, MAPPED_STORE_VERSION, self.generation,
+            epoch | 1, self.data_start, 0, 0, evictions, self.slots)
+        self.map[HEADER_SIZE:self.data_start] = '\0' * (self.data_start - HEADER_SIZE)
+        HEADER.pack_into(self.map, 0, MAPPED_STORE_MAGIC, MAPPED_STORE_VERSION, self.generation,
+            (epoch | 1) + 1, self.data_start, 0, 0, evictions, self.slots)
+
+    def hash_key(self, key):
+        """
+        Returns the text of `key`, its MD5 digest and its hash.
+        """
+        text = get_key_text(key)
+        digest = md5_constructor(text).digest()
+        return text, digest, struct.unpack('<Q', digest[:8])[0] | 1
+
+    def find(self, text, digest, hash):
+        """
+        Returns the slot position of `hash` and the offset of the record of key `text`, 0
+        if it is not in the store.
+        """
+        position = hash % self.slots
+        for i in xrange(self.slots):
+            slot_hash, offset = SLOT.unpack_from(self.map, HEADER_SIZE + position * SLOT.size)
+            if not slot_hash:
+                break
+            if slot_hash == hash:
+                record_digest, key_length = RECORD.unpack_from(self.map, offset)[:2]
+                start = offset + RECORD.size
+                if record_digest == digest and self.map[start:start + key_length] == text:
+                    return position, offset
+            position = (position + 1) % self.slots
+        return position, 0
+
+    def get(self, key):
+        text, digest, hash = self.hash_key(key)
+        header = HEADER.unpack_from(self.map, 0)
+        epoch = header[EPOCH]
+        value = None
+        if header[2] == self.generation and not epoch % 2:
+            try:
+                offset = self.find(text, digest, hash)[1]
+                if offset:
+                    key_length, length, flags = RECORD.unpack_from(self.map, offset)[1:]
+                    start = offset + RECORD.size + key_length
+                    value = self.map[start:start + length]
+            except struct.error:
+                value = None
+            # The store was emptied while reading
+            if HEADER.unpack_from(self.map, 0)[EPOCH] != epoch:
+                value = None
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if flags & COMPRESSED_FLAG:
+            value = zlib.decompress(value)
+        if not flags & SEGMENTS_FLAG:
+            return value.decode('utf-8')
+
+        segments, position = [], 0
+        while position < len(value):
+            length = SEGMENT.unpack_from(value, position)[0]
+            position += SEGMENT.size
+            segments.append(value[position:position + length].decode('utf-8'))
+            position += length
+        return tuple(segments)
+
+    def set(self, key, value):
+        text, digest, hash = self.hash_key(key)
+        if isinstance(value, tuple):
+            flags = SEGMENTS_FLAG
+            data = ''.join([SEGMENT.pack(len(segment)) + segment
+                for segment in [segment.encode('utf-8') for segment in value]])
+        else:
+            flags = 0
+            data = value.encode('utf-8')
+        compressed = bool(self.compress_threshold) and len(data) >= self.compress_threshold
+        if compressed:
+            flags |= COMPRESSED_FLAG
+            data = zlib.compress(data)
+        data = text + data
+        if self.data_start + RECORD.size + len(data) > self.size:
+            return
+
+        self.acquire()
+        try:
+            header = HEADER.unpack_from(self.map, 0)
+            if header[2] != self.generation:
+                return
+            position, offset = self.find(text, digest, hash)
+            if offset:
+                return
+
+            data_end, entries = header[DATA_END], header[ENTRIES]
+            if data_end + RECORD.size + len(data) > self.size or (entries + 1) * 4 > self.slots * 3:
+                self.reset(header[EPOCH] + 1, header[EVICTIONS] + entries)
+                header = HEADER.unpack_from(self.map, 0)
+                position, offset = self.find(text, digest, hash)
+                data_end, entries = header[DATA_END], header[ENTRIES]
+
+            # The record is written before the slot pointing to it
+            RECORD.pack_into(self.map, data_end, digest, len(text), len(data) - len(text), flags)
+            self.map[data_end + RECORD.size:data_end + RECORD.size + len(data)] = data
+            SLOT.pack_into(self.map, HEADER_SIZE + position * SLOT.size, hash, data_end)
+            HEADER.pack_into(self.map, 0, MAPPED_STORE_MAGIC, MAPPED_STORE_VERSION, self.generation,
+                header[EPOCH], data_end + RECORD.size + len(data), entries + 1,
+                header[COMPRESSED] + compressed, header[EVICTIONS], self.slots)
+        finally:
+            self.release()
+
+    def clear(self):
+        self.acquire()
+        try:
+            header = HEADER.unpack_from(self.map, 0)
+            self.reset(header[EPOCH] + 1)
+        finally:
+            self.release()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with `hits` and `misses` of this process, and `evictions`,
+        `entries`, `compressed` entries and `bytes` held by the shared store.
+        """
+        header = HEADER.unpack_from(self.map, 0)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': header[EVICTIONS],
+            'entries': header[ENTRIES],
+            'compressed': header[COMPRESSED],
+            'bytes': header[DATA_END] - self.data_start,
+        }
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def get_key_text(key):
+    """
+    Returns a UTF-8 string standing for `key`, the same in every process. Classes stand
+    for their module and name.
+    """
+    if isinstance(key, tuple):
+        return '(%s)' % ','.join([get_key_text(bit) for bit in key])
+    if isinstance(key, basestring):
+        return repr(force_unicode(key)).lstrip('u')
+    if isinstance(key, (type, types.ClassType)):
+        return '<%s.%s>' % (key.__module__, key.__name__)
+    if key is None or isinstance(key, (bool, int, long, float)):
+        return repr(key)
+    raise TypeError("Fragment keys can't hold %r" % key)
+
+
+_store = None
+
+def load_store():
+    """
+    Returns the store configured in `UNIFORM_FRAGMENT_STORE` settings, or a `FragmentStore`.
+    """
+    store = getattr(settings, 'UNIFORM_FRAGMENT_STORE', None)
+    if store is None:
+        return FragmentStore()
+    if isinstance(store, basestring):
+        module_name, class_name = store.rsplit('.', 1)
+        try:
+            store = getattr(import_module(module_name), class_name)()
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured("Error loading uni_form fragment store %s: %s" % (store, e))
+    return store
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = load_store()
+    return _store
+
+def set_store(store):
+    """
+    Keeps fragments in `store` from now on, instead of the store in settings.
+    """
+    global _store
+    _store = store
@@ -1,6 +1,7 @@
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.utils.safestring import mark_safe
 
+from uni_form import metrics, trace
 from utils import render_field
 
 
@@ -54,6 +55,19 @@ class FormHelper(object):
         **form_style**: Uni-form has two built in different form styles. You can choose
             your favorite. This can be set to "default" or "inline". Defaults to "default".
 
+        **placeholders**: List of context variable names. When set, the form is rendered with
+            placeholders for the CSRF token and these variables, so that the output can be cached
+            and filled in later on using `{% uni_form_fill %}` or `uni_form.utils.fill_placeholders`.
+            Defaults to None, which renders values right away.
+
+        **render_empty_form**: When rendering an unbound formset, its extra forms are not
+            rendered. Instead `formset.empty_form` is rendered once into a `<template>` element,
+            that `uni-form.jquery.js` clones for adding forms on the client. Defaults to False.
+
+        **template_pack**: Name of a directory of templates used instead of `uni_form` ones,
+            when it has them, for rendering the form. Defaults to None, which uses the
+            `uni_form_template_pack` context variable or `UNIFORM_TEMPLATE_PACK` setting.
+
     Public Methods:
         
         **add_input(input)**: You can add input buttons using this method. Inputs
@@ -102,6 +116,9 @@ class FormHelper(object):
     form_tag = True
     form_error_title = None
     formset_error_title = None
+    placeholders = None
+    render_empty_form = False
+    template_pack = None
 
     def __init__(self):
         self.inputs = self.inputs[:]
@@ -157,7 +174,10 @@ class FormHelper(object):
         """
         Returns safe html of the rendering of the layout
         """
+        timer = metrics.start('render_layout')
+        span = trace.span(u'Layout', 'layout', form=form.__class__.__name__)
         form.rendered_fields = []
+        form.omitted_fields = []
         
         html = self.layout.render(form, self.form_style, context)
 
@@ -165,6 +185,10 @@ class FormHelper(object):
             if not field in form.rendered_fields:
                 html += render_field(field, form, self.form_style, context)
 
+        if span is not None:
+            span.finish()
+        if timer is not None:
+            timer.stop(fields=len(form.rendered_fields), **metrics.get_tags(form, self))
         return mark_safe(html)
     
     def get_attributes(self):
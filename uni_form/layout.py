@@ -1,17 +1,24 @@
-from django.template import Context, Template
-from django.template.loader import render_to_string
+import logging
 
-from utils import render_field
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.forms.util import flatatt
+from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
+
+from uni_form.templatetags.uni_form_field import FieldDescriptor
+from utils import render_field, render_field_template, render_to_string, get_snippet, get_pack_template_name
 
 
 class Layout(object):
     """ 
     Form Layout. It is conformed by Layout objects: `Fieldset`, `Row`, `Column`, `MultiField`,
-    `HTML`, `ButtonHolder`, `Button`, `Hidden`, `Reset`, `Submit` and fields. Form fields 
-    have to be strings.
+    `Conditional`, `Deferred`, `LargeChoiceField`, `HTML`, `ButtonHolder`, `Button`, `Hidden`,
+    `Reset`, `Submit` and fields. Form fields have to be strings.
     
-    Layout objects `Fieldset`, `Row`, `Column`, `MultiField` and `ButtonHolder` can hold other 
-    Layout objects within. Though `ButtonHolder` should only hold `HTML` and BaseInput 
+    Layout objects `Fieldset`, `Row`, `Column`, `MultiField`, `Conditional`, `Deferred` and
+    `ButtonHolder` can hold other Layout objects within. Though `ButtonHolder` should only hold `HTML` and BaseInput 
     inherited classes: `Button`, `Hidden`, `Reset` and `Submit`.
     
     You need to add your `Layout` to the `FormHelper` using its method `add_layout`.
@@ -39,6 +46,7 @@ class Layout(object):
     """
     def __init__(self, *fields):
         self.fields = list(fields)
+        self._index = None
     
     def render(self, form, form_style, context):
         html = ""
@@ -46,6 +54,149 @@ class Layout(object):
             html += render_field(field, form, form_style, context)
         return html
 
+    def get_node(self, key):
+        """
+        Returns the field name or layout object identified by `key`, which is a field name
+        or a layout object `css_id`. Raises `KeyError` if there is none.
+        """
+        return self._locate(key)[1]
+
+    def insert_before(self, key, *nodes):
+        """
+        Inserts `nodes` before the field or layout object identified by `key`::
+
+            layout.insert_before('email', HTML("<p>We won't spam you</p>"))
+        """
+        ancestors, node, positions = self._locate(key)
+        self._insert(ancestors, positions[:-1], positions[-1], nodes)
+
+    def insert_after(self, key, *nodes):
+        """
+        Inserts `nodes` after the field or layout object identified by `key`.
+        """
+        ancestors, node, positions = self._locate(key)
+        self._insert(ancestors, positions[:-1], positions[-1] + 1, nodes)
+
+    def remove(self, key):
+        """
+        Removes the field or layout object identified by `key` and returns it.
+        """
+        ancestors, node, positions = self._locate(key)
+        ancestors[-1].fields.pop(positions[-1])
+        self._unindex_node(node)
+        return node
+
+    def replace(self, key, new_node):
+        """
+        Replaces the field or layout object identified by `key` with `new_node` and
+        returns the replaced one.
+        """
+        ancestors, node, positions = self._locate(key)
+        ancestors[-1].fields[positions[-1]] = new_node
+        self._unindex_node(node)
+        self._index_node(new_node, ancestors, positions)
+        return node
+
+    def wrap(self, key, layout_class, *args, **kwargs):
+        """
+        Wraps the field or layout object identified by `key` in a new `layout_class`
+        object and returns it. `args` are passed before the wrapped node::
+
+            layout.wrap('notes', Fieldset, 'Notes', css_id='notes-fieldset')
+        """
+        ancestors, node, positions = self._locate(key)
+        wrapper = layout_class(*(args + (node,)), **kwargs)
+        ancestors[-1].fields[positions[-1]] = wrapper
+        self._unindex_node(node)
+        self._index_node(wrapper, ancestors, positions)
+        return wrapper
+
+    def _insert(self, ancestors, parent_positions, position, nodes):
+        ancestors[-1].fields[position:position] = list(nodes)
+        for offset, new_node in enumerate(nodes):
+            self._index_node(new_node, ancestors, parent_positions + (position + offset,))
+
+    def _locate(self, key):
+        """
+        Returns a tuple with the ancestors of the node identified by `key`, starting by
+        this layout, the node itself and the positions of every node of the path in its
+        parent's `fields`. The index is rebuilt if `fields` lists have been changed directly.
+        """
+        if self._index is None:
+            self._build_index()
+
+        entry = self._index.get(key)
+        if entry is None or not self._is_attached(entry):
+            self._build_index()
+            entry = self._index.get(key)
+            if entry is None:
+                raise KeyError("Layout has no field or layout object '%s'" % key)
+
+        ancestors, node, positions = entry
+        return ancestors, node, tuple(positions)
+
+    def _is_attached(self, entry):
+        """
+        Returns whether every node in the path from this layout to the node of index
+        `entry` is still in its parent's `fields`, checking the positions it holds. Nodes
+        moved by changes next to them are looked up in their parent and their positions
+        updated.
+        """
+        ancestors, node, positions = entry
+        path = ancestors + (node,)
+        for depth, position in enumerate(positions):
+            parent, child = path[depth], path[depth + 1]
+            if position >= len(parent.fields) or not self._is_node(parent.fields[position], child):
+                position = self._position(parent, child)
+                if position is None:
+                    return False
+                positions[depth] = position
+        return True
+
+    def _is_node(self, field, node):
+        return field is node or (isinstance(node, basestring) and field == node)
+
+    def _position(self, parent, node):
+        """
+        Returns the position of `node` in `parent.fields` or None if it's not there.
+        """
+        for position, field in enumerate(parent.fields):
+            if self._is_node(field, node):
+                return position
+
+    def _build_index(self):
+        self._index = {}
+        for position, node in enumerate(self.fields):
+            self._index_node(node, (self,), (position,))
+
+    def _node_keys(self, node, ancestors=(), positions=()):
+        """
+        Yields tuples with the key, ancestors, node and positions of `node` and all nodes
+        within it.
+        """
+        if isinstance(node, basestring):
+            yield node, ancestors, node, positions
+        elif getattr(node, 'css_id', None):
+            yield node.css_id, ancestors, node, positions
+
+        for position, child in enumerate(getattr(node, 'fields', ())):
+            for entry in self._node_keys(child, ancestors + (node,), positions + (position,)):
+                yield entry
+
+    def _index_node(self, node, ancestors, positions):
+        if self._index is None:
+            return
+        for key, node_ancestors, key_node, node_positions in self._node_keys(node, ancestors, positions):
+            self._index.setdefault(key, (node_ancestors, key_node, list(node_positions)))
+
+    def _unindex_node(self, node):
+        if self._index is None:
+            return
+        for key, node_ancestors, key_node, node_positions in self._node_keys(node):
+            entry = self._index.get(key)
+            if entry is not None and entry[1] is key_node:
+                del self._index[key]
+
 
 class ButtonHolder(object):
     """
@@ -74,7 +225,7 @@ class ButtonHolder(object):
         for field in self.fields:
             html += render_field(field, form, form_style, context)
 
-        return render_to_string(self.template, Context({'buttonholder': self, 'fields_output': html}))
+        return render_to_string(self.template, {'buttonholder': self, 'fields_output': html}, context)
 
 
 class BaseInput(object):
@@ -96,7 +247,7 @@ class BaseInput(object):
         """
         Renders an `<input />` if container is used as a Layout object
         """
-        return render_to_string(self.template, Context({'input': self}))
+        return render_to_string(self.template, {'input': self}, context)
 
 
 class Submit(BaseInput):
@@ -161,12 +312,15 @@ class Fieldset(object):
             'form_field_1',
             'form_field_2'
         )
+
+    Lazy translations, like `ugettext_lazy` strings, are kept lazy and translated
+    when the fieldset is rendered.
     """
     template = "uni_form/layout/fieldset.html"
 
     def __init__(self, legend, *fields, **kwargs):
         self.fields = list(fields)
-        self.legend = unicode(legend)
+        self.legend = legend
         self.css_class = kwargs.get('css_class', '')
         self.css_id = kwargs.get('css_id', None)
         # Overrides class variable with an instance level variable
@@ -179,8 +333,8 @@ class Fieldset(object):
 
         legend = ''
         if self.legend:
-            legend = u'%s' % Template(self.legend).render(context)
-        return render_to_string(self.template, Context({'fieldset': self, 'legend': legend, 'fields': fields, 'form_style': form_style}))
+            legend = u'%s' % get_snippet(self.legend).render(context)
+        return render_to_string(self.template, {'fieldset': self, 'legend': legend, 'fields': fields, 'form_style': form_style}, context)
 
 
 class MultiField(object):
@@ -189,8 +343,8 @@ class MultiField(object):
 
     def __init__(self, label, *fields, **kwargs):
         #TODO: Decide on how to support css classes for both container divs
-        self.fields = fields
-        self.label_html = unicode(label)
+        self.fields = list(fields)
+        self.label_html = label
         self.label_class = kwargs.get('label_class', u'blockLabel')
         self.css_class = kwargs.get('css_class', u'ctrlHolder')
         self.css_id = kwargs.get('css_id', None)
@@ -208,7 +362,7 @@ class MultiField(object):
         for field in self.fields:
             fields_output += render_field(field, form, form_style, context, 'uni_form/multifield.html', self.label_class, layout_object=self)
         
-        return render_to_string(self.template, Context({'multifield': self, 'fields_output': fields_output}))
+        return render_to_string(self.template, {'multifield': self, 'fields_output': fields_output}, context)
 
 
 class Div(object):
@@ -222,7 +376,7 @@ class Div(object):
     template = "uni_form/layout/div.html"
 
     def __init__(self, *fields, **kwargs):
-        self.fields = fields
+        self.fields = list(fields)
         
         if hasattr(self, 'css_class') and kwargs.has_key('css_class'):
             self.css_class += ' %s' % kwargs.get('css_class')
@@ -237,7 +391,7 @@ class Div(object):
         for field in self.fields:
             fields += render_field(field, form, form_style, context)
 
-        return render_to_string(self.template, Context({'div': self, 'fields': fields}))
+        return render_to_string(self.template, {'div': self, 'fields': fields}, context)
 
 
 class Row(Div):
@@ -258,6 +412,212 @@ class Column(Div):
     css_class = 'formColumn'
 
 
+class Conditional(object):
+    """
+    Layout object. It renders the layout objects and fields within only when `predicate`
+    returns True. `predicate` is called with the form, the context and the user, taken
+    from the context `user` or `request.user`, None if there is none::
+
+        Conditional(lambda form, context, user: user.is_staff,
+            Fieldset('Moderation', 'is_approved', 'notes')
+        )
+
+    Otherwise nothing within is rendered, and its fields are marked as omitted, so they
+    are not rendered after the layout either. They are added to `form.omitted_fields`.
+    """
+    def __init__(self, predicate, *fields, **kwargs):
+        self.predicate = predicate
+        self.fields = list(fields)
+        self.css_id = kwargs.get('css_id', None)
+
+    def render(self, form, form_style, context):
+        user = context.get('user')
+        if user is None:
+            user = getattr(context.get('request'), 'user', None)
+
+        if self.predicate(form, context, user):
+            html = u''
+            for field in self.fields:
+                html += render_field(field, form, form_style, context)
+            return html
+
+        if not hasattr(form, 'omitted_fields'):
+            form.omitted_fields = []
+        for field in self.get_field_names():
+            if field not in form.rendered_fields:
+                form.rendered_fields.append(field)
+                form.omitted_fields.append(field)
+        return u''
+
+    def get_field_names(self):
+        """
+        Returns the names of the fields within, at any depth.
+        """
+        return get_field_names(self.fields)
+
+
+class Deferred(object):
+    """
+    Layout object. It renders a placeholder for a layout object, typically a `Fieldset`
+    or a `Div`, which is rendered when the user opens it, fetching it from the
+    `uni_form.views.render_deferred` view. `source` is the name the form and helper
+    factory was registered with, see `uni_form.views.register_deferred`::
+
+        Deferred('profile', Fieldset('Shipping preferences', 'carrier', 'instructions'),
+            css_id='shipping')
+
+    The placeholder shows `label`, by default the wrapped fieldset legend. `css_id` is
+    required, by default the wrapped node's one. The fields within are not rendered
+    after the layout, they are added to `form.deferred_fields`.
+    """
+    template = "uni_form/layout/deferred.html"
+
+    def __init__(self, source, node, **kwargs):
+        self.source = source
+        self.fields = [node]
+        self.label = kwargs.get('label', getattr(node, 'legend', None))
+        self.css_id = kwargs.get('css_id', getattr(node, 'css_id', None))
+        self.css_class = kwargs.get('css_class', '')
+        self.template = kwargs.get('template', self.template)
+        if not self.css_id:
+            raise TypeError("Deferred layout objects need a css_id")
+
+    def render(self, form, form_style, context):
+        if not hasattr(form, 'deferred_fields'):
+            form.deferred_fields = []
+        for field in get_field_names(self.fields):
+            if field not in form.rendered_fields:
+                form.rendered_fields.append(field)
+                form.deferred_fields.append(field)
+
+        label = ''
+        if self.label:
+            label = get_snippet(self.label).render(context)
+        url = reverse('uni_form_deferred', kwargs={'source': self.source, 'key': self.css_id})
+        return render_to_string(self.template, {'deferred': self, 'label': label, 'url': url}, context)
+
+    def render_node(self, form, form_style, context):
+        """
+        Renders the deferred layout object itself.
+        """
+        html = u''
+        for field in self.fields:
+            html += render_field(field, form, form_style, context)
+        return html
+
+
+class LargeChoiceField(object):
+    """
+    Layout object. It renders a choice field with lots of choices as a text input showing
+    the label of the selected choice, and a hidden input holding its value. Choices are
+    fetched as the user types from the `uni_form.views.render_choices` view, a paged JSON
+    endpoint built from the field choices or queryset. `source` is the name the form and
+    helper factory was registered with, see `uni_form.views.register_deferred`::
+
+        LargeChoiceField('city', 'profile', search_fields=['name__istartswith'])
+
+    `search_fields` are queryset lookups the search text is matched against, for model
+    choice fields. Without them choices are matched by their label in Python. Field
+    validation doesn't change. Fields with multiple choices are not supported.
+    """
+    template = "uni_form/field.html"
+    page_size = 50
+
+    def __init__(self, field, source, **kwargs):
+        self.fields = [field]
+        self.source = source
+        self.search_fields = kwargs.get('search_fields', None)
+        self.page_size = kwargs.get('page_size', self.page_size)
+        self.template = kwargs.get('template', self.template)
+
+    def render(self, form, form_style, context):
+        name = self.fields[0]
+        try:
+            bound_field = FieldDescriptor(form[name])
+        except KeyError:
+            if not getattr(settings, 'UNIFORM_FAIL_SILENTLY', True):
+                raise Exception("Could not resolve form field '%s'." % name)
+            logging.warning("Could not resolve form field '%s'." % name)
+            return u''
+
+        if name not in form.rendered_fields:
+            form.rendered_fields.append(name)
+        bound_field._widget_html = self.render_widget(bound_field)
+
+        context.update({'field': bound_field, 'labelclass': None})
+        try:
+            template = get_pack_template_name(self.template, context)
+            return render_field_template(template, bound_field, form, form_style, context)
+        finally:
+            context.pop()
+
+    def render_widget(self, bound_field):
+        value = bound_field.value()
+        if value is None:
+            value = u''
+        url = reverse('uni_form_choices', kwargs={'source': self.source, 'field': self.fields[0]})
+
+        hidden_attrs = {'type': 'hidden', 'name': bound_field.html_name, 'value': force_unicode(value)}
+        text_attrs = {
+            'type': 'text',
+            'value': get_choice_label(bound_field.field, value),
+            'class': 'largeChoice %s' % bound_field.input_class,
+            'autocomplete': 'off',
+            'data-choices-url': url,
+        }
+        if bound_field.auto_id:
+            hidden_attrs['id'] = '%s_value' % bound_field.auto_id
+            text_attrs['id'] = bound_field.auto_id
+        return mark_safe(u'<input%s /><input%s />' % (flatatt(hidden_attrs), flatatt(text_attrs)))
+
+
+def get_choice_label(field, value):
+    """
+    Returns the label of the choice of `field` with `value`, or an empty string.
+    """
+    if value in (None, u''):
+        return u''
+
+    if hasattr(field, 'queryset'):
+        try:
+            instance = field.to_python(value)
+        except ValidationError:
+            return u''
+        return instance is not None and field.label_from_instance(instance) or u''
+
+    value = force_unicode(value)
+    for choice_value, choice_label in iter_choices(field.choices):
+        if force_unicode(choice_value) == value:
+            return force_unicode(choice_label)
+    return u''
+
+def iter_choices(choices):
+    """
+    Yields choices, flattening option groups.
+    """
+    for choice_value, choice_label in choices:
+        if isinstance(choice_label, (list, tuple)):
+            for option in choice_label:
+                yield option
+        else:
+            yield choice_value, choice_label
+
+
+def get_field_names(nodes):
+    """
+    Returns the names of the fields in `nodes` and within them, at any depth.
+    """
+    names = []
+    nodes = list(reversed(nodes))
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, basestring):
+            names.append(node)
+        else:
+            nodes.extend(reversed(getattr(node, 'fields', ())))
+    return names
+
+
 class HTML(object):
     """ 
     Layout object. It can contain pure HTML and it has access to the whole
@@ -270,7 +630,7 @@ class HTML(object):
     """
     
     def __init__(self, html):
-        self.html = unicode(html)
+        self.html = html
     
     def render(self, form, form_style, context):
-        return Template(self.html).render(context)
+        return get_snippet(self.html).render(context)
@@ -0,0 +1,133 @@
+import cProfile
+import gc
+import pstats
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.forms.formsets import formset_factory
+from django.template import Context, Template
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from uni_form import stats
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def import_object(path):
+    module_name, _, name = path.rpartition('.')
+    try:
+        return getattr(import_module(module_name), name)
+    except (ImportError, AttributeError, ValueError), e:
+        raise CommandError("Could not import '%s': %s" % (path, e))
+
+
+class Command(BaseCommand):
+    args = '<form class path>'
+    help = ("Renders a form repeatedly through the {% uni_form %} tag under cProfile, printing "
+        "per render averages, the top functions and the top allocation sites.")
+    option_list = BaseCommand.option_list + (
+        make_option('--helper', dest='helper',
+            help='Dotted path of a callable returning the FormHelper, called without arguments. '
+                 'Defaults to the form helper attribute, if any.'),
+        make_option('--formset', dest='formset', type='int',
+            help='Render a formset of the form with this many extra forms.'),
+        make_option('--data', dest='data',
+            help='JSON file with the data to bind the form or formset to.'),
+        make_option('--renders', dest='renders', type='int', default=100,
+            help='Number of renders, 100 by default.'),
+        make_option('--top', dest='top', type='int', default=20,
+            help='Number of top functions and allocation sites to print, 20 by default.'),
+        make_option('--sort', dest='sort', default='cumulative',
+            help='pstats sort key for top functions, cumulative by default.'),
+        make_option('--prof-file', dest='prof_file',
+            help='Save the profile in this .prof file, for pstats, snakeviz or similar tools.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: uniform_profile %s" % self.args)
+        form_class = import_object(args[0])
+
+        data = None
+        if options.get('data'):
+            data_file = open(options['data'])
+            try:
+                data = simplejson.load(data_file)
+            finally:
+                data_file.close()
+
+        if options.get('formset') is not None:
+            formset_class = formset_factory(form_class, extra=options['formset'])
+            make_form = lambda: formset_class(data)
+        else:
+            make_form = lambda: form_class(data)
+
+        if options.get('helper'):
+            helper = import_object(options['helper'])()
+        else:
+            helper = getattr(make_form(), 'helper', None)
+
+        if helper is None:
+            template = Template(u'{% load uni_form_tags %}{% uni_form form %}')
+        else:
+            template = Template(u'{% load uni_form_tags %}{% uni_form form helper %}')
+
+        def render(form):
+            return template.render(Context({'form': form, 'helper': helper}))
+
+        # First render loads templates and fills caches, like the first request would
+        render(make_form())
+        renders = options['renders']
+
+        # Every render gets a new form, built before profiling so that the averages
+        # only hold rendering
+        started = time.time()
+        forms = [make_form() for i in xrange(renders)]
+        construction = time.time() - started
+
+        render_stats = stats.start_collecting()
+        profile = cProfile.Profile()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        gc.collect()
+        objects_before = len(gc.get_objects())
+
+        started = time.time()
+        try:
+            for form in forms:
+                profile.runcall(render, form)
+        finally:
+            elapsed = time.time() - started
+            stats.stop_collecting(render_stats)
+            if tracemalloc is not None:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+        gc.collect()
+        objects_after = len(gc.get_objects())
+
+        self.stdout.write("%d renders of %s in %.3f sec, %.3f ms per render (profiled)\n" % (
+            renders, args[0], elapsed, elapsed * 1000 / renders))
+        self.stdout.write("    forms built beforehand in %.3f ms per form (not profiled)\n" % (
+            construction * 1000 / renders))
+        for counter in stats.COUNTERS:
+            self.stdout.write("    %s per render: %.1f\n" % (counter, float(render_stats[counter]) / renders))
+
+        self.stdout.write("\nTop functions:\n")
+        pstats.Stats(profile, stream=self.stdout).strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
+
+        if tracemalloc is not None:
+            self.stdout.write("Top allocation sites:\n")
+            for statistic in snapshot.statistics('lineno')[:options['top']]:
+                self.stdout.write("    %s\n" % statistic)
+        else:
+            self.stdout.write("tracemalloc is not available, objects alive after rendering grew by %d\n" % (
+                objects_after - objects_before))
+
+        if options.get('prof_file'):
+            profile.dump_stats(options['prof_file'])
+            self.stdout.write("Profile saved to %s\n" % options['prof_file'])
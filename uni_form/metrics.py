@@ -0,0 +1,178 @@
+"""
+Sampled render metrics. When `UNIFORM_METRICS_SINK` is set, `{% uni_form %}` and
+`|as_uni_form` renders are sampled at `UNIFORM_METRICS_SAMPLE_RATE` (1.0 by default), and
+for sampled renders timers of the whole render, `FormHelper.render_layout` and every
+`render_field` call are sent to the sink, along with a counter of fields rendered.
+
+Metrics are named `<UNIFORM_METRICS_PREFIX>.<name>`, `uni_form.render` by default, and
+tagged with the form class, the helper's `form_id` and the formset size.
+
+`UNIFORM_METRICS_SINK` is the dotted path of a sink class, like
+`'uni_form.metrics.StatsdSink'`, instantiated without arguments, or a sink instance.
+Sinks implement::
+
+    timing(name, milliseconds, tags, sample_rate)
+    incr(name, value, tags, sample_rate)
+"""
+import logging
+import random
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+class StatsdSink(object):
+    """
+    Sends metrics over UDP in statsd format, with DogStatsD style tags. Defaults to
+    `UNIFORM_STATSD_HOST` and `UNIFORM_STATSD_PORT` settings, `localhost:8125`.
+    Network errors are ignored, metrics must never break a page.
+    """
+    def __init__(self, host=None, port=None):
+        if host is None:
+            host = getattr(settings, 'UNIFORM_STATSD_HOST', 'localhost')
+        if port is None:
+            port = getattr(settings, 'UNIFORM_STATSD_PORT', 8125)
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, milliseconds, tags, sample_rate):
+        self.send('%s:%.3f|ms' % (name, milliseconds), tags, sample_rate)
+
+    def incr(self, name, value, tags, sample_rate):
+        self.send('%s:%d|c' % (name, value), tags, sample_rate)
+
+    def send(self, metric, tags, sample_rate):
+        if sample_rate < 1:
+            metric += '|@%s' % sample_rate
+        if tags:
+            metric += '|#' + ','.join(['%s:%s' % (key, tags[key]) for key in sorted(tags)])
+        try:
+            self.socket.sendto(metric, self.address)
+        except socket.error:
+            pass
+
+
+class LoggingSink(object):
+    """
+    Logs every metric to the `uni_form.metrics` logger, in one line.
+    """
+    def __init__(self, logger='uni_form.metrics'):
+        self.logger = logging.getLogger(logger)
+
+    def timing(self, name, milliseconds, tags, sample_rate):
+        self.log('timing', name, '%.3fms' % milliseconds, tags, sample_rate)
+
+    def incr(self, name, value, tags, sample_rate):
+        self.log('counter', name, value, tags, sample_rate)
+
+    def log(self, kind, name, value, tags, sample_rate):
+        tags = ' '.join(['%s=%s' % (key, tags[key]) for key in sorted(tags)])
+        self.logger.info("%s %s %s sample_rate=%s %s" % (kind, name, value, sample_rate, tags))
+
+
+class MemorySink(object):
+    """
+    Keeps metrics in `metrics`, a list of `(kind, name, value, tags, sample_rate)` tuples.
+    Useful for tests.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def timing(self, name, milliseconds, tags, sample_rate):
+        self.metrics.append(('timing', name, milliseconds, tags, sample_rate))
+
+    def incr(self, name, value, tags, sample_rate):
+        self.metrics.append(('counter', name, value, tags, sample_rate))
+
+    def names(self):
+        return [metric[1] for metric in self.metrics]
+
+
+_sink = None
+_sink_loaded = False
+_local = threading.local()
+
+def load_sink():
+    """
+    Returns the sink configured in `UNIFORM_METRICS_SINK` settings, or None.
+    """
+    sink = getattr(settings, 'UNIFORM_METRICS_SINK', None)
+    if isinstance(sink, basestring):
+        module_name, class_name = sink.rsplit('.', 1)
+        try:
+            sink = getattr(import_module(module_name), class_name)()
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured("Error loading uni_form metrics sink %s: %s" % (sink, e))
+    return sink
+
+def get_sink():
+    global _sink, _sink_loaded
+    if not _sink_loaded:
+        _sink = load_sink()
+        _sink_loaded = True
+    return _sink
+
+def set_sink(sink):
+    """
+    Sends metrics to `sink` from now on, instead of the sink in settings. None disables them.
+    """
+    global _sink, _sink_loaded
+    _sink = sink
+    _sink_loaded = True
+
+
+class Timer(object):
+    def __init__(self, sink, name, sample_rate, owns_sample):
+        self.sink = sink
+        self.name = name
+        self.sample_rate = sample_rate
+        self.owns_sample = owns_sample
+        self.started = time.time()
+
+    def stop(self, fields=None, **tags):
+        """
+        Sends the time elapsed since the timer started, and `fields` rendered if given.
+        """
+        milliseconds = (time.time() - self.started) * 1000
+        if self.owns_sample:
+            _local.sampled = False
+
+        prefix = getattr(settings, 'UNIFORM_METRICS_PREFIX', 'uni_form')
+        self.sink.timing('%s.%s' % (prefix, self.name), milliseconds, tags, self.sample_rate)
+        if fields is not None:
+            self.sink.incr('%s.fields' % prefix, fields, tags, self.sample_rate)
+
+
+def start(name, sample=False):
+    """
+    Returns a started `Timer` for metric `name`, or None if it isn't measured. Top level
+    renders pass `sample=True`, deciding whether the render is sampled. Everything else
+    is measured only within sampled renders.
+    """
+    sink = get_sink()
+    if sink is None:
+        return None
+
+    sample_rate = getattr(settings, 'UNIFORM_METRICS_SAMPLE_RATE', 1.0)
+    if getattr(_local, 'sampled', False):
+        return Timer(sink, name, sample_rate, False)
+    if not sample or random.random() >= sample_rate:
+        return None
+
+    _local.sampled = True
+    return Timer(sink, name, sample_rate, True)
+
+def get_tags(form, helper=None):
+    """
+    Returns the tags for metrics of rendering `form`, a form or a formset.
+    """
+    tags = {'form': form.__class__.__name__}
+    if helper is not None and helper.form_id:
+        tags['helper'] = helper.form_id
+    if hasattr(form, 'forms'):
+        tags['formset_size'] = len(form.forms)
+    return tags
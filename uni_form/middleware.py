@@ -0,0 +1,56 @@
+import logging
+
+from django.conf import settings
+
+from uni_form import dedup, stats
+
+
+class RenderAccountingMiddleware(object):
+    """
+    Collects how much work django-uni-form does for every request, see `uni_form.stats`,
+    and reports it in a `Server-Timing` response header like::
+
+        Server-Timing: uniform;dur=12.5;desc="renders=1 fields=8 template_loads=0 ..."
+
+    Set `UNIFORM_RENDER_LOG` to True for logging it too, in one line per request, to
+    the `uni_form` logger.
+    """
+    def process_request(self, request):
+        request.uni_form_stats = stats.start_collecting()
+
+    def process_response(self, request, response):
+        render_stats = getattr(request, 'uni_form_stats', None)
+        if render_stats is None:
+            return response
+        stats.stop_collecting(render_stats)
+
+        duration = render_stats.render_time * 1000
+        summary = render_stats.summary()
+        timing = 'uniform;dur=%.2f;desc="%s"' % (duration, summary)
+        if response.has_header('Server-Timing'):
+            timing = '%s, %s' % (response['Server-Timing'], timing)
+        response['Server-Timing'] = timing
+
+        if getattr(settings, 'UNIFORM_RENDER_LOG', False):
+            logging.getLogger('uni_form').info("uni_form render path=%s status=%s time_ms=%.2f %s" % (
+                request.path, response.status_code, duration, summary))
+
+        return response
+
+
+class RenderDedupMiddleware(object):
+    """
+    Renders every form only once per request: rendering again the same form instance,
+    with an equivalent helper and the same context inputs, returns the earlier output
+    with its DOM ids suffixed, see `uni_form.dedup`. Renders are dropped once the response
+    is done, or the view raises.
+    """
+    def process_request(self, request):
+        dedup.start()
+
+    def process_response(self, request, response):
+        dedup.stop()
+        return response
+
+    def process_exception(self, request, exception):
+        dedup.stop()
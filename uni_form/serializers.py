@@ -0,0 +1,284 @@
+"""
+Compact JSON descriptors of helpers and layouts, and of form state.
+
+A helper descriptor holds the helper attributes, its inputs and its layout. It doesn't
+depend on the request, so it can be cached anywhere: in the browser, a CDN or a shared
+cache, built out of process and turned back into a `FormHelper` cheaply in workers::
+
+    from uni_form.serializers import dumps_helper, loads_helper
+
+    descriptor = dumps_helper(form.helper)
+    helper = loads_helper(descriptor)
+
+Bound values and errors are sent apart, in a small form state payload built by
+`dumps_form_state`.
+
+Layout objects are serialized as `[type, args, fields]` lists, followed by a dictionary
+of the attributes that differ from their defaults, if any. Fields are strings. Legends,
+labels and `HTML` contents are serialized in the active language. `Conditional`
+predicates have to be module level functions, they are serialized by dotted path.
+"""
+from django.forms.formsets import BaseFormSet
+from django.forms.widgets import FileInput, PasswordInput
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+from django.utils.importlib import import_module
+
+from uni_form.helper import FormHelper
+from uni_form.layout import Layout, ButtonHolder, Submit, Button, Hidden, Reset, Fieldset, \
+    MultiField, Div, Row, Column, Conditional, Deferred, LargeChoiceField, HTML
+
+
+DESCRIPTOR_VERSION = 1
+
+
+class SerializationError(Exception):
+    """
+    This is raised when a layout, helper or descriptor can't be serialized or loaded.
+    """
+    pass
+
+
+# Layout object type name: (class, positional attributes, attributes and their defaults)
+# `*` marks where the layout object fields go among the positional arguments. Defaults
+# that are not listed are the class attribute, or None.
+BASE_INPUT_ATTRS = {'field_classes': None, 'template': None}
+CONTAINER_ATTRS = {'css_class': None, 'css_id': None, 'template': None}
+
+layout_types = {
+    'Layout': (Layout, ('*',), {}),
+    'ButtonHolder': (ButtonHolder, ('*',), CONTAINER_ATTRS),
+    'Submit': (Submit, ('name', 'value'), BASE_INPUT_ATTRS),
+    'Button': (Button, ('name', 'value'), BASE_INPUT_ATTRS),
+    'Hidden': (Hidden, ('name', 'value'), BASE_INPUT_ATTRS),
+    'Reset': (Reset, ('name', 'value'), BASE_INPUT_ATTRS),
+    'Fieldset': (Fieldset, ('legend', '*'), {'css_class': '', 'css_id': None, 'template': None}),
+    'MultiField': (MultiField, ('label_html', '*'), {'label_class': u'blockLabel',
+        'css_class': u'ctrlHolder', 'css_id': None, 'template': None}),
+    'Div': (Div, ('*',), {'css_class': None, 'css_id': '', 'template': None}),
+    'Row': (Row, ('*',), {'css_class': None, 'css_id': '', 'template': None}),
+    'Column': (Column, ('*',), {'css_class': None, 'css_id': '', 'template': None}),
+    'Conditional': (Conditional, ('predicate', '*'), {'css_id': None}),
+    'Deferred': (Deferred, ('source', '*'), {'label': None, 'css_id': None, 'css_class': '',
+        'template': None}),
+    'LargeChoiceField': (LargeChoiceField, ('*', 'source'), {'search_fields': None,
+        'page_size': None, 'template': None}),
+    'HTML': (HTML, ('html',), {}),
+}
+
+# Helper attribute: the attribute it is stored in
+helper_attrs = (
+    ('form_method', '_form_method'),
+    ('form_action', '_form_action'),
+    ('form_style', '_form_style'),
+    ('form_id', 'form_id'),
+    ('form_class', 'form_class'),
+    ('form_tag', 'form_tag'),
+    ('form_error_title', 'form_error_title'),
+    ('formset_error_title', 'formset_error_title'),
+    ('placeholders', 'placeholders'),
+    ('render_empty_form', 'render_empty_form'),
+    ('template_pack', 'template_pack'),
+)
+
+
+def get_type_name(node):
+    for name, (cls, positional, attrs) in layout_types.items():
+        if node.__class__ is cls:
+            return name
+    raise SerializationError("Layout object %r can't be serialized" % node)
+
+def serialize_value(value):
+    if isinstance(value, Promise):
+        return force_unicode(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+def serialize_predicate(predicate):
+    name = getattr(predicate, '__name__', '<lambda>')
+    if name == '<lambda>' or getattr(import_module(predicate.__module__), name, None) is not predicate:
+        raise SerializationError("Conditional predicate %r is not a module level function" % predicate)
+    return '%s.%s' % (predicate.__module__, name)
+
+def load_predicate(path):
+    module_name, name = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module_name), name)
+    except (ImportError, AttributeError), e:
+        raise SerializationError("Error loading Conditional predicate %s: %s" % (path, e))
+
+def serialize_layout(node):
+    """
+    Returns the descriptor of a layout object or field name, made of lists, dictionaries
+    and strings.
+    """
+    if isinstance(node, basestring):
+        return force_unicode(node)
+
+    name = get_type_name(node)
+    cls, positional, attrs = layout_types[name]
+    args = []
+    for attr in positional:
+        if attr == 'predicate':
+            args.append(serialize_predicate(node.predicate))
+        elif attr != '*':
+            args.append(serialize_value(getattr(node, attr)))
+    fields = [serialize_layout(field) for field in getattr(node, 'fields', ())]
+
+    descriptor = [name, args, fields]
+    changed = {}
+    for attr, default in attrs.items():
+        value = getattr(node, attr, None)
+        if value != attrs[attr] and value != getattr(cls, attr, default):
+            changed[attr] = serialize_value(value)
+    if changed:
+        descriptor.append(changed)
+    return descriptor
+
+def load_layout(descriptor):
+    """
+    Returns the layout object or field name of a descriptor built by `serialize_layout`.
+    """
+    if isinstance(descriptor, basestring):
+        return descriptor
+
+    try:
+        name, args, fields = descriptor[:3]
+        cls, positional, attrs = layout_types[name]
+    except (ValueError, TypeError, KeyError):
+        raise SerializationError("Invalid layout descriptor %r" % (descriptor,))
+
+    fields = [load_layout(field) for field in fields]
+    args = list(args)
+    arguments = []
+    # Deferred layout objects need a css_id when they are built
+    kwargs = {}
+    changed = len(descriptor) > 3 and descriptor[3] or {}
+    if 'css_id' in changed:
+        kwargs['css_id'] = changed['css_id']
+    try:
+        for attr in positional:
+            if attr == '*':
+                arguments.extend(fields)
+            elif attr == 'predicate':
+                arguments.append(load_predicate(args.pop(0)))
+            else:
+                arguments.append(args.pop(0))
+        node = cls(*arguments, **kwargs)
+    except (IndexError, TypeError), e:
+        raise SerializationError("Invalid %s descriptor %r: %s" % (name, descriptor, e))
+    for attr, value in changed.items():
+        setattr(node, str(attr), value)
+    return node
+
+def serialize_helper(helper):
+    """
+    Returns the descriptor of a `FormHelper`: the attributes that differ from the
+    defaults, its inputs and its layout.
+    """
+    descriptor = {'v': DESCRIPTOR_VERSION}
+    for attr, stored_attr in helper_attrs:
+        value = getattr(helper, stored_attr)
+        if value != getattr(FormHelper, stored_attr):
+            descriptor[attr] = serialize_value(value)
+    if helper.inputs:
+        descriptor['inputs'] = [serialize_layout(input) for input in helper.inputs]
+    if helper.layout is not None:
+        descriptor['layout'] = serialize_layout(helper.layout)
+    return descriptor
+
+def load_helper(descriptor):
+    """
+    Returns a `FormHelper` built from a descriptor returned by `serialize_helper`.
+    """
+    if descriptor.get('v') != DESCRIPTOR_VERSION:
+        raise SerializationError("Unsupported descriptor version %r" % descriptor.get('v'))
+
+    helper = FormHelper()
+    for attr, stored_attr in helper_attrs:
+        if attr in descriptor:
+            setattr(helper, attr, descriptor[attr])
+    for input in descriptor.get('inputs', ()):
+        helper.add_input(load_layout(input))
+    if 'layout' in descriptor:
+        helper.add_layout(load_layout(descriptor['layout']))
+    return helper
+
+def dumps_helper(helper):
+    """
+    Returns the compact JSON descriptor of a `FormHelper`.
+    """
+    return simplejson.dumps(serialize_helper(helper), separators=(',', ':'))
+
+def loads_helper(data):
+    """
+    Returns a `FormHelper` built from a JSON descriptor returned by `dumps_helper`.
+    """
+    try:
+        descriptor = simplejson.loads(data)
+    except ValueError, e:
+        raise SerializationError("Invalid descriptor: %s" % e)
+    return load_helper(descriptor)
+
+
+def serialize_field_value(value):
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [serialize_field_value(item) for item in value]
+    return force_unicode(getattr(value, 'name', value))
+
+def renders_value(widget):
+    """
+    Returns whether `widget` renders its value. Password inputs, unless they are told
+    to, and file inputs don't, so their values are left out of form states.
+    """
+    if isinstance(widget, PasswordInput):
+        return widget.render_value
+    return not isinstance(widget, FileInput)
+
+def serialize_form(form):
+    state = {}
+    if form.prefix:
+        state['prefix'] = form.prefix
+
+    values = {}
+    for name, field in form.fields.items():
+        if not renders_value(field.widget):
+            continue
+        value = serialize_field_value(form[name].value())
+        if value not in (None, u'', []):
+            values[name] = value
+    if values:
+        state['values'] = values
+
+    if form.is_bound and form.errors:
+        state['errors'] = dict([(name, [force_unicode(error) for error in errors])
+            for name, errors in form.errors.items()])
+    return state
+
+def serialize_form_state(form):
+    """
+    Returns the state of a form or formset: non empty field values, errors and prefix.
+    Values of password and file inputs are left out. Formsets hold their management form values and the state of every form.
+    """
+    if isinstance(form, BaseFormSet):
+        state = {'v': DESCRIPTOR_VERSION, 'forms': [serialize_form(f) for f in form.forms]}
+        state['management'] = serialize_form(form.management_form).get('values', {})
+        if form.prefix:
+            state['prefix'] = form.prefix
+        if form.is_bound and form.non_form_errors():
+            state['errors'] = [force_unicode(error) for error in form.non_form_errors()]
+        return state
+
+    state = serialize_form(form)
+    state['v'] = DESCRIPTOR_VERSION
+    return state
+
+def dumps_form_state(form):
+    """
+    Returns the compact JSON state of a form or formset.
+    """
+    return simplejson.dumps(serialize_form_state(form), separators=(',', ':'))
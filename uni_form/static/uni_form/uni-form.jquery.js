@@ -8,4 +8,22 @@ jQuery.fn.uniform=function(settings){settings=jQuery.extend({valid_class:'valid'
 if(text){$p.html(text);}};form.submit(function(){form.find(settings.field_selector).each(function(){if($(this).val()==$(this).data('default-value'))$(this).val("");});})
 form.find(settings.field_selector).each(function(){var $input=$(this),value=$input.val();$input.data('default-color',$input.css('color'));if(value==$input.data('default-value')||!value){$input.not('select').css("color",settings.default_value_color);$input.val($input.data('default-value'));}})
 form.delegate(settings.field_selector,'focus',function(){form.find('.'+settings.focused_class).removeClass(settings.focused_class);var $input=$(this);$input.parents().filter('.'+settings.holder_class+':first').addClass(settings.focused_class);if($input.val()==$input.data('default-value')){$input.val("");}
-$input.not('select').css('color',$input.data('default-color'));});form.delegate(settings.field_selector,'blur',function(){var $input=$(this);form.find('.'+settings.focused_class).removeClass(settings.focused_class);if($input.val()==""||$input.val()==$input.data('default-value')){$input.not('select').css("color",settings.default_value_color);$input.val($input.data('default-value'));}else{$input.css('color',$input.data('default-color'));}});form.delegate(settings.field_selector,'error',function(e,text){validate($(this),false,text);});form.delegate(settings.field_selector,'success',function(e,text){validate($(this),true);});});};
\ No newline at end of file
+$input.not('select').css('color',$input.data('default-color'));});form.delegate(settings.field_selector,'blur',function(){var $input=$(this);form.find('.'+settings.focused_class).removeClass(settings.focused_class);if($input.val()==""||$input.val()==$input.data('default-value')){$input.not('select').css("color",settings.default_value_color);$input.val($input.data('default-value'));}else{$input.css('color',$input.data('default-color'));}});form.delegate(settings.field_selector,'error',function(e,text){validate($(this),false,text);});form.delegate(settings.field_selector,'success',function(e,text){validate($(this),true);});});};
+
+/**
+ * Deferred layout objects: opening one fetches its content, passing along the page query string
+ */
+jQuery(document).delegate('div.deferred a.deferredLabel','click',function(e){e.preventDefault();var $deferred=jQuery(this).closest('div.deferred');if($deferred.data('loading'))return;$deferred.data('loading',true);jQuery.get($deferred.data('deferred-url')+window.location.search,function(html){$deferred.replaceWith(html);}).error(function(){$deferred.data('loading',false);});});
+
+/**
+ * Large choice fields: typing searches choices, paged, and picking one sets the hidden input value
+ */
+(function($){var load=function($input,page){$.getJSON($input.data('choices-url'),{q:$input.val(),page:page},function(data){var $list=$input.next('ul.largeChoices');if(!$list.length){$list=$('<ul class="largeChoices"></ul>').insertAfter($input);}
+if(page==1){$list.empty();}$list.find('li.more').remove();$.each(data.results,function(i,choice){$('<li></li>').text(choice.label).data('value',choice.value).appendTo($list);});if(data.has_next){$('<li class="more">&hellip;</li>').data('page',page+1).appendTo($list);}});};$(document).delegate('input.largeChoice','keyup',function(){var $input=$(this);clearTimeout($input.data('timer'));$input.data('timer',setTimeout(function(){load($input,1);},250));});$(document).delegate('ul.largeChoices li','click',function(){var $li=$(this),$list=$li.parent(),$input=$list.prev('input.largeChoice');if($li.hasClass('more')){load($input,$li.data('page'));return;}
+$input.val($li.text()).prev('input[type=hidden]').val($li.data('value'));$list.remove();});})(jQuery);
+
+/**
+ * Formsets rendered with FormHelper.render_empty_form: elements with a data-add-form attribute,
+ * set to the formset prefix, add a form cloning the empty form and update TOTAL_FORMS
+ */
+jQuery(document).delegate('[data-add-form]','click',function(e){e.preventDefault();var prefix=jQuery(this).data('add-form'),$template=jQuery('#'+prefix+'-empty-form'),$total=jQuery('#id_'+prefix+'-TOTAL_FORMS'),max=parseInt(jQuery('#id_'+prefix+'-MAX_NUM_FORMS').val(),10),index=parseInt($total.val(),10);if(!isNaN(max)&&index>=max)return;$template.before($template.html().replace(/__prefix__/g,index));$total.val(index+1);});
@@ -0,0 +1,97 @@
+"""
+Render accounting: counts how much work django-uni-form does while collecting is on
+in the current thread. `uni_form.middleware.RenderAccountingMiddleware` collects per
+request. Counting costs nothing noticeable while nobody is collecting.
+
+Counters:
+
+    * `renders`: `{% uni_form %}` tags and `|as_uni_form`, `|as_uni_errors` and
+      `|as_uni_field` filters rendered.
+    * `fields`: Fields rendered.
+    * `template_loads`: Templates loaded through the template loaders.
+    * `template_cache_hits`: Templates taken from django-uni-form's cache.
+    * `compilations`: Layout snippets compiled with `Template()`.
+    * `contexts`: `Context` objects created.
+    * `bytes`: UTF-8 encoded size of the rendered output.
+"""
+import threading
+import time
+
+from django.utils.functional import wraps
+
+
+COUNTERS = ('renders', 'fields', 'template_loads', 'template_cache_hits', 'compilations',
+    'contexts', 'bytes')
+
+_local = threading.local()
+
+
+class RenderStats(object):
+    """
+    Counters collected while it is active, plus `render_time`, the time in seconds spent
+    in outermost renders.
+    """
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.render_time = 0.0
+
+    def __getitem__(self, name):
+        return self.counters[name]
+
+    def summary(self):
+        """
+        Returns counters as a string of space separated `name=value` pairs.
+        """
+        return u' '.join(['%s=%d' % (name, self.counters[name]) for name in COUNTERS])
+
+
+def start_collecting():
+    """
+    Returns a new `RenderStats`, collecting from now on in the current thread until
+    `stop_collecting` is called with it. Several of them can be collecting at once.
+    """
+    render_stats = RenderStats()
+    _local.collectors = getattr(_local, 'collectors', ()) + (render_stats,)
+    return render_stats
+
+def stop_collecting(render_stats):
+    _local.collectors = tuple([collector for collector in getattr(_local, 'collectors', ())
+        if collector is not render_stats])
+
+def incr(name, value=1):
+    """
+    Adds `value` to counter `name` of every `RenderStats` collecting in this thread.
+    """
+    for render_stats in getattr(_local, 'collectors', ()):
+        render_stats.counters[name] += value
+
+
+def accounted(render):
+    """
+    Decorator for the rendering entry points: template tag `render` methods and filters
+    returning the rendered output. Counts a render, and the time and bytes of outermost ones.
+    """
+    @wraps(render)
+    def wrapper(*args, **kwargs):
+        if not getattr(_local, 'collectors', ()):
+            return render(*args, **kwargs)
+
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        started = time.time()
+        html = u''
+        try:
+            html = render(*args, **kwargs)
+            return html
+        finally:
+            elapsed = time.time() - started
+            _local.depth = depth
+            for render_stats in getattr(_local, 'collectors', ()):
+                render_stats.counters['renders'] += 1
+                if depth == 0:
+                    render_stats.render_time += elapsed
+                    render_stats.counters['bytes'] += len(unicode(html).encode('utf-8'))
+
+    # Django checks filter arguments against the decorated function
+    wrapper._decorated_function = getattr(render, '_decorated_function', render)
+    return wrapper
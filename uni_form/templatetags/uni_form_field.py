@@ -1,5 +1,7 @@
 from django import template
 
+from uni_form import stats
+
 register = template.Library()
 
 class_converter = {
@@ -8,14 +10,92 @@ class_converter = {
     "passwordinput": "textinput textInput",
 }
 
+# Widget class -> (CSS class name, is checkbox), filled on demand by `get_widget_classes`.
+# Changes to `class_converter` apply only to widget classes not seen yet.
+widget_classes_cache = {}
+
+def get_widget_classes(widget):
+    """
+    Returns a tuple with the CSS class name uni-form applies to `widget` and a boolean
+    telling if it is a checkbox. Results are cached per widget class.
+    """
+    try:
+        return widget_classes_cache[widget.__class__]
+    except KeyError:
+        class_name = widget.__class__.__name__.lower()
+        classes = (class_converter.get(class_name, class_name), class_name == "checkboxinput")
+        widget_classes_cache[widget.__class__] = classes
+        return classes
+
+
+class FieldDescriptor(object):
+    """
+    Everything field templates need for rendering a `BoundField`, computed once per render.
+    Attributes not defined here are looked up in the bound field, so templates written
+    for bound fields, like `{{ field.field.widget }}`, keep working.
+
+    The widget is rendered with uni-form CSS classes without modifying it, as widgets
+    are shared by every form instance rendering the field.
+    """
+    def __init__(self, bound_field):
+        stats.incr('fields')
+        self.bound_field = bound_field
+        self._widget_html = None
+        widget = bound_field.field.widget
+
+        self.auto_id = bound_field.auto_id
+        self.is_hidden = widget.is_hidden
+        self.label = bound_field.label
+        self.help_text = bound_field.help_text
+        self.errors = bound_field.errors
+        self.required = bound_field.field.required
+        self.widget_class, self.is_checkbox = get_widget_classes(widget)
+        self.css_classes = bound_field.css_classes()
+        self.input_class = bound_field.css_classes(extra_classes=self.widget_class)
+
+        holder_class = ['ctrlHolder']
+        if self.errors:
+            holder_class.append('error')
+        if self.is_checkbox:
+            holder_class.append('checkbox')
+        if widget.attrs.get('class'):
+            holder_class.append(widget.attrs['class'])
+        if self.css_classes:
+            holder_class.append(self.css_classes)
+        self.holder_class = ' '.join(holder_class)
+
+    def __getattr__(self, name):
+        if name == 'bound_field':
+            raise AttributeError(name)
+        return getattr(self.bound_field, name)
+
+    def __unicode__(self):
+        return unicode(self.bound_field)
+
+    def _get_widget_html(self):
+        if self._widget_html is None:
+            html = self.bound_field.as_widget(attrs={'class': self.input_class})
+            if self.bound_field.field.show_hidden_initial:
+                html += self.bound_field.as_hidden(only_initial=True)
+            self._widget_html = html
+        return self._widget_html
+    widget_html = property(_get_widget_html)
+
+
+@register.filter
+def field_descriptor(field):
+    """
+    Returns the `FieldDescriptor` of a bound field, field templates use it for
+    computing everything they need only once.
+    """
+    if isinstance(field, FieldDescriptor):
+        return field
+    return FieldDescriptor(field)
+
 @register.filter
 def is_checkbox(field):
-    return field.field.widget.__class__.__name__.lower() == "checkboxinput"
+    return get_widget_classes(field.field.widget)[1]
 
 @register.filter
 def with_class(field):
-    class_name = field.field.widget.__class__.__name__.lower()
-    class_name = class_converter.get(class_name, class_name)
-    field.field.widget.attrs['class'] = field.css_classes(extra_classes=class_name)
-
-    return field
+    return field_descriptor(field).widget_html
@@ -2,17 +2,16 @@
 from django.conf import settings
 from django.forms.formsets import BaseFormSet
 from django.template import Context
-from django.template.loader import get_template
 from django import template
 
+from uni_form import dedup, metrics, stats
 from uni_form.helper import FormHelper
-
-uni_formset_template = get_template('uni_form/uni_formset.html')
-uni_form_template = get_template('uni_form/uni_form.html')
+from uni_form.utils import get_pack_template
 
 register = template.Library()
 
 @register.filter
+@stats.accounted
 def as_uni_form(form):
     """ 
     The original and still very useful way to generate a uni-form form/formset::
@@ -24,21 +23,33 @@ def as_uni_form(form):
             {{ myform|as_uni_form }}
         </form>
     """
+    key = None
+    if dedup.is_on():
+        key = dedup.get_key(form, None, None)
+        if key is not None:
+            html = dedup.get(key)
+            if html is not None:
+                return html
+
+    timer = metrics.start('as_uni_form', sample=True)
     if isinstance(form, BaseFormSet):
-        if settings.DEBUG:
-            template = get_template('uni_form/uni_formset.html')
-        else:
-            template = uni_formset_template
+        template = get_pack_template('uni_form/uni_formset.html')
         c = Context({'formset': form})
     else:
-        if settings.DEBUG:
-            template = get_template('uni_form/uni_form.html')
-        else:
-            template = uni_form_template
+        template = get_pack_template('uni_form/uni_form.html')
         c = Context({'form': form})
-    return template.render(c)
+    stats.incr('contexts')
+    try:
+        html = template.render(c)
+    finally:
+        if timer is not None:
+            timer.stop(**metrics.get_tags(form))
+    if key is not None:
+        dedup.add(key, html)
+    return html
 
 @register.filter
+@stats.accounted
 def as_uni_errors(form):
     """
     Renders only form errors like django-uni-form::
@@ -47,14 +58,16 @@ def as_uni_errors(form):
         {{ form|as_uni_errors }}
     """
     if isinstance(form, BaseFormSet):
-        template = get_template('uni_form/errors_formset.html')
+        template = get_pack_template('uni_form/errors_formset.html')
         c = Context({'formset': form})
     else:
-        template = get_template('uni_form/errors.html')
+        template = get_pack_template('uni_form/errors.html')
         c = Context({'form':form})
+    stats.incr('contexts')
     return template.render(c)
 
 @register.filter
+@stats.accounted
 def as_uni_field(field):
     """
     Renders a form field like a django-uni-form field::
@@ -62,8 +75,9 @@ def as_uni_field(field):
         {% load uni_form_tags %}
         {{ form.field|as_uni_field }}
     """
-    template = get_template('uni_form/field.html')
+    template = get_pack_template('uni_form/field.html')
     c = Context({'field':field})
+    stats.incr('contexts')
     return template.render(c)
 
 @register.inclusion_tag("uni_form/includes.html", takes_context=True)
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
-from django.forms.formsets import BaseFormSet
-from django.template import Context
-from django.template.loader import get_template
+import logging
+
+from django.conf import settings
+from django.forms.formsets import BaseFormSet, ManagementForm, TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, \
+    MAX_NUM_FORM_COUNT
 from django import template
 
+from uni_form import dedup, metrics, stats, trace
 from uni_form.helper import FormHelper
+from uni_form.templatetags.uni_form_field import FieldDescriptor
+from uni_form.utils import get_pack_template, get_placeholders, fill_placeholders
 
 register = template.Library()
 # We import the filters, so they are available when doing load uni_form_tags
@@ -22,9 +27,13 @@ class ForLoopSimulator(object):
         
         Fieldset("Item {{ forloop.counter }}", [...])
         HTML("{% if forloop.first %}First form text{% endif %}"
+
+    It also holds a `render_cache`, where layout snippets keep output they can reuse
+    while rendering the formset's `forms`.
     """
-    def __init__(self, formset):
-        self.len_values = len(formset.forms)
+    def __init__(self, forms):
+        self.len_values = len(forms)
+        self.render_cache = {}
     
         # Shortcuts for current loop iteration number.
         self.counter = 1
@@ -45,7 +54,17 @@ class ForLoopSimulator(object):
         self.revcounter -= 1
         self.revcounter0 -= 1
         self.first = False
-        self.last = (self.revcounter0 == self.len_values - 1)
+        self.last = (self.revcounter0 == 0)
+
+    def extend(self):
+        """
+        Updates values as if the loop had one more item after the ones iterated over,
+        and it was the current one. Used for rendering the formset's empty form.
+        """
+        self.len_values += 1
+        self.revcounter = 1
+        self.revcounter0 = 0
+        self.last = True
 
 
 class BasicNode(template.Node):
@@ -63,49 +82,118 @@ class BasicNode(template.Node):
         else:
             self.helper = None
 
-    def get_render(self, context):
+    def resolve(self, context):
+        """
+        Returns `self.form` and `self.helper` resolved into real Python objects from the
+        `context`, the helper being None if there is none.
+        """
+        actual_form = self.form.resolve(context)
+        if self.helper is None:
+            return actual_form, None
+
+        helper = self.helper.resolve(context)
+        if not isinstance(helper, FormHelper):
+            raise TypeError('helper object provided to uni_form tag must be a uni_form.helpers.FormHelper object.')
+        return actual_form, helper
+
+    def get_render(self, context, actual_form, helper):
         """ 
-        Returns a `Context` object with all the necesarry stuff for rendering the form
+        Pushes into `context` all the necesarry stuff for rendering the form and returns it.
+        Callers have to pop it from `context` once they are done rendering.
 
         :param context: `django.template.Context` variable holding the context for the node
 
-        `self.form` and `self.helper` are resolved into real Python objects resolving them
-        from the `context`. The `actual_form` can be a form or a formset. If it's a formset 
-        `is_formset` is set to True. If the helper has a layout we use it, for rendering the
-        form or the formset's forms.
+        `actual_form` and `helper` are `self.form` and `self.helper` resolved by `resolve`.
+        The `actual_form` can be a form or a formset. If it's a formset `is_formset` is set
+        to True. If the helper has a layout we use it, for rendering the form or the
+        formset's forms.
         """
-        actual_form = self.form.resolve(context)
         attrs = {}
-        if self.helper is not None:
-            helper = self.helper.resolve(context)
-
-            if not isinstance(helper, FormHelper):
-                raise TypeError('helper object provided to uni_form tag must be a uni_form.helpers.FormHelper object.')
+        if helper is not None:
             attrs = helper.get_attributes()
-        else:
-            helper = None
-
-        # We get the response dictionary 
-        is_formset = isinstance(actual_form, BaseFormSet)
-        response_dict = self.get_response_dict(attrs, context, is_formset)
-
-        # If we have a helper's layout we use it, for the form or the formset's forms
-        if helper and helper.layout:
-            if not is_formset:
-                actual_form.form_html = helper.render_layout(actual_form, context)
-            else:
-                forloop = ForLoopSimulator(actual_form)
-                for form in actual_form.forms:
-                    context.update({'forloop': forloop})
-                    form.form_html = helper.render_layout(form, context)
-                    forloop.iterate()
 
+        # Per-request values are replaced by placeholders, so the output can be cached
+        placeholders = helper is not None and helper.placeholders is not None
+        if placeholders:
+            context.update(get_placeholders(helper.placeholders))
+
+        # The helper's template pack is used for everything rendered within
+        template_pack = helper is not None and helper.template_pack
+        if template_pack:
+            context.update({'uni_form_template_pack': template_pack})
+
+        try:
+            # We get the response dictionary 
+            is_formset = isinstance(actual_form, BaseFormSet)
+            response_dict = self.get_response_dict(attrs, context, is_formset)
+
+            # Extra forms are added on the client, cloning the empty form
+            render_empty_form = is_formset and helper is not None and helper.render_empty_form
+            if is_formset:
+                forms = actual_form.forms
+                management_form = actual_form.management_form
+                if render_empty_form and not actual_form.is_bound:
+                    forms = forms[:actual_form.initial_form_count()]
+                    management_form = self.get_management_form(actual_form, len(forms))
+
+                response_dict.update({'formset_forms': forms, 'management_form': management_form})
+
+            # If we have a helper's layout we use it, for the form or the formset's forms
+            if helper and helper.layout:
+                if not is_formset:
+                    actual_form.form_html = helper.render_layout(actual_form, context)
+                else:
+                    forloop = ForLoopSimulator(forms)
+                    context.update({'forloop': forloop})
+                    try:
+                        for form in forms:
+                            form.form_html = helper.render_layout(form, context)
+                            forloop.iterate()
+
+                        # The empty form is rendered as the one after the last form
+                        if render_empty_form:
+                            forloop.extend()
+                            response_dict['empty_form_html'] = helper.render_layout(actual_form.empty_form, context)
+                    finally:
+                        context.pop()
+            elif render_empty_form:
+                response_dict['empty_form_html'] = self.render_empty_form(actual_form, helper, context)
+        finally:
+            if template_pack:
+                context.pop()
+            if placeholders:
+                context.pop()
+
+        if template_pack:
+            response_dict['uni_form_template_pack'] = template_pack
         if is_formset:
             response_dict.update({'formset': actual_form})
         else:
             response_dict.update({'form': actual_form})
 
-        return Context(response_dict)
+        context.update(response_dict)
+        return context
+
+    def get_management_form(self, formset, total_forms):
+        """
+        Returns the management form of unbound `formset` when it renders `total_forms` forms.
+        """
+        return ManagementForm(auto_id=formset.auto_id, prefix=formset.prefix, initial={
+            TOTAL_FORM_COUNT: total_forms,
+            INITIAL_FORM_COUNT: formset.initial_form_count(),
+            MAX_NUM_FORM_COUNT: formset.max_num,
+        })
+
+    def render_empty_form(self, formset, helper, context):
+        """
+        Returns the html of `formset.empty_form`, for helpers without a layout. With a
+        layout, it is rendered along with the formset's forms.
+        """
+        context.update({'form': formset.empty_form, 'form_style': helper.form_style})
+        try:
+            return get_pack_template('uni_form/uni_form.html', context).render(context)
+        finally:
+            context.pop()
 
     def get_response_dict(self, attrs, context, is_formset):
         """
@@ -139,25 +227,46 @@ class BasicNode(template.Node):
         return response_dict
 
 
-whole_uni_formset_template = get_template('uni_form/whole_uni_formset.html')
-whole_uni_form_template = get_template('uni_form/whole_uni_form.html')
-
 class UniFormNode(BasicNode):
+    @stats.accounted
     def render(self, context):
-        c = self.get_render(context)
-
-        if c['is_formset']:
-            if settings.DEBUG:
-                template = get_template('uni_form/whole_uni_formset.html')
-            else:
-                template = whole_uni_formset_template
-        else:
-            if settings.DEBUG:
-                template = get_template('uni_form/whole_uni_form.html')
-            else:
-                template = whole_uni_form_template
-
-        return template.render(c)
+        actual_form, helper = self.resolve(context)
+        key = None
+        if dedup.is_on():
+            key = dedup.get_key(actual_form, helper, context)
+            if key is not None:
+                html = dedup.get(key)
+                if html is not None:
+                    return html
+
+        html = self.render_form(context, actual_form, helper)
+        if key is not None:
+            dedup.add(key, html)
+        return html
+
+    def render_form(self, context, actual_form, helper):
+        timer = metrics.start('render', sample=True)
+        recorder = trace.start_render_trace()
+        span = trace.span(u'uni_form', 'render')
+
+        try:
+            c = self.get_render(context, actual_form, helper)
+            try:
+                if c['is_formset']:
+                    template = get_pack_template('uni_form/whole_uni_formset.html', c)
+                else:
+                    template = get_pack_template('uni_form/whole_uni_form.html', c)
+
+                return template.render(c)
+            finally:
+                c.pop()
+        finally:
+            if span is not None:
+                span.finish()
+            if recorder is not None:
+                trace.finish_render_trace(recorder, actual_form.__class__.__name__)
+            if timer is not None:
+                timer.stop(**metrics.get_tags(actual_form, helper))
 
 
 # {% uni_form %} tag
@@ -185,3 +294,196 @@ def do_uni_form(parser, token):
         helper = None
 
     return UniFormNode(form, helper)
+
+
+class PackIncludeNode(template.Node):
+    def __init__(self, template_name):
+        self.template_name = template_name
+
+    def render(self, context):
+        context.update({})
+        try:
+            return get_pack_template(self.template_name, context).render(context)
+        finally:
+            context.pop()
+
+
+# {% uni_form_include %} tag
+@register.tag(name="uni_form_include")
+def do_uni_form_include(parser, token):
+    """
+    Like `{% include %}`, but taking the template from the template pack in use, see
+    `uni_form.utils.get_pack_template`. django-uni-form templates use it, so packs can
+    override any of them::
+
+        {% uni_form_include "uni_form/field.html" %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 2 or bits[1][0] not in ('"', "'") or bits[1][0] != bits[1][-1]:
+        raise template.TemplateSyntaxError("%r tag takes a quoted template name as its only argument" % bits[0])
+
+    return PackIncludeNode(bits[1][1:-1])
+
+
+class UniFormFillNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        return fill_placeholders(self.nodelist.render(context), context)
+
+
+# {% uni_form_fill %} tag
+@register.tag(name="uni_form_fill")
+def do_uni_form_fill(parser, token):
+    """
+    Fills in the placeholders left by forms rendered with `FormHelper.placeholders` set.
+    Its content is typically cached, while the placeholders are filled on every request::
+
+        {% load cache uni_form_tags %}
+
+        {% uni_form_fill %}
+            {% cache 600 contact_form %}
+                {% uni_form form form.helper %}
+            {% endcache %}
+        {% end_uni_form_fill %}
+    """
+    nodelist = parser.parse(('end_uni_form_fill',))
+    parser.delete_first_token()
+
+    return UniFormFillNode(nodelist)
+
+
+class FieldsRenderer(object):
+    """
+    Renders fields of a form by name, and its errors, using already loaded templates and
+    the context of the page. It keeps track of the fields rendered, so that the rest of
+    them can be rendered at the end.
+    """
+    def __init__(self, form, context):
+        self.form = form
+        self.rendered_fields = set()
+        self.template = get_pack_template('uni_form/field.html', context)
+        self.errors_template = None
+
+    def render(self, names, context):
+        html = u''
+        for name in names:
+            try:
+                bound_field = self.form[name]
+            except KeyError:
+                if not getattr(settings, 'UNIFORM_FAIL_SILENTLY', True):
+                    raise Exception("Could not resolve form field '%s'." % name)
+                logging.warning("Could not resolve form field '%s'." % name)
+                continue
+
+            self.rendered_fields.add(name)
+            context.update({'field': FieldDescriptor(bound_field)})
+            try:
+                html += self.template.render(context)
+            finally:
+                context.pop()
+
+        return html
+
+    def render_remaining(self, context):
+        names = [name for name in self.form.fields.keys() if name not in self.rendered_fields]
+        return self.render(names, context)
+
+    def render_errors(self, context):
+        if self.errors_template is None:
+            self.errors_template = get_pack_template('uni_form/errors.html', context)
+
+        context.update({'form': self.form})
+        try:
+            return self.errors_template.render(context)
+        finally:
+            context.pop()
+
+
+class UniFieldsNode(template.Node):
+    def __init__(self, form, nodelist):
+        self.form = template.Variable(form)
+        self.nodelist = nodelist
+
+    def render(self, context):
+        context.update({'uni_fields': FieldsRenderer(self.form.resolve(context), context)})
+        try:
+            return self.nodelist.render(context)
+        finally:
+            context.pop()
+
+
+class UniFieldNode(template.Node):
+    def __init__(self, names, remaining=False, errors=False):
+        self.names = names
+        self.remaining = remaining
+        self.errors = errors
+
+    def render(self, context):
+        try:
+            fields_renderer = context['uni_fields']
+        except KeyError:
+            raise template.TemplateSyntaxError("uni_field tags must be used within a uni_fields tag")
+
+        if self.errors:
+            return fields_renderer.render_errors(context)
+        if self.remaining:
+            return fields_renderer.render_remaining(context)
+        return fields_renderer.render(self.names, context)
+
+
+# {% uni_fields %} tag
+@register.tag(name="uni_fields")
+def do_uni_fields(parser, token):
+    """
+    Fast way of laying out fields by hand. Within the tag, `{% uni_field %}` renders
+    fields by name like `|as_uni_field` filter does, reusing the template and the
+    context, `{% uni_errors %}` renders the form errors like `|as_uni_errors` does and
+    `{% uni_remaining_fields %}` renders the fields not rendered yet::
+
+        {% load uni_form_tags %}
+
+        {% uni_fields form %}
+            {% uni_errors %}
+            <div class="personal">{% uni_field first_name last_name %}</div>
+            {% uni_field email %}
+            {% uni_remaining_fields %}
+        {% end_uni_fields %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("%r tag takes the form as its only argument" % bits[0])
+
+    nodelist = parser.parse(('end_uni_fields',))
+    parser.delete_first_token()
+
+    return UniFieldsNode(bits[1], nodelist)
+
+# {% uni_field %} tag
+@register.tag(name="uni_field")
+def do_uni_field(parser, token):
+    """
+    Renders one or more fields by name, see `{% uni_fields %}`.
+    """
+    names = [name.strip('"\'') for name in token.split_contents()[1:]]
+    if not names:
+        raise template.TemplateSyntaxError("uni_field tag needs at least a field name")
+
+    return UniFieldNode(names)
+
+# {% uni_remaining_fields %} tag
+@register.tag(name="uni_remaining_fields")
+def do_uni_remaining_fields(parser, token):
+    """
+    Renders the fields not rendered yet within a `{% uni_fields %}` tag.
+    """
+    return UniFieldNode([], remaining=True)
+
+# {% uni_errors %} tag
+@register.tag(name="uni_errors")
+def do_uni_errors(parser, token):
+    """
+    Renders the form errors within a `{% uni_fields %}` tag.
+    """
+    return UniFieldNode([], errors=True)
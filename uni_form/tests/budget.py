@@ -0,0 +1,69 @@
+"""
+Render budgets for test suites. They lock in how much work rendering forms takes, so
+that performance regressions, like loading templates once per field, make tests fail::
+
+    from uni_form.tests.budget import assertUniFormBudget
+
+    with assertUniFormBudget(max_template_loads=0, max_queries=1, max_fields=8):
+        html = render_to_string('signup.html', {'form': form})
+
+Limits are `max_<counter>` for every counter in `uni_form.stats`: `renders`, `fields`,
+`template_loads`, `template_cache_hits`, `compilations`, `contexts` and `bytes`, plus
+`max_queries` for database queries. `UniFormBudgetMixin` adds the same method to test cases.
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from uni_form import stats
+
+
+LIMITS = tuple(['max_%s' % counter for counter in stats.COUNTERS]) + ('max_queries',)
+
+
+class UniFormBudget(object):
+    """
+    Context manager collecting render counters and database queries while it is
+    active, and raising `AssertionError` on exit if any of them is over its limit.
+    Once exited, `counts` holds every count by name.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, **limits):
+        for limit in limits:
+            if limit not in LIMITS:
+                raise TypeError("Unknown uni_form budget limit '%s'" % limit)
+        self.limits = limits
+        self.connection = connections[using]
+        self.counts = {}
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.starting_queries = len(self.connection.queries)
+        self.render_stats = stats.start_collecting()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stats.stop_collecting(self.render_stats)
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        if exc_type is not None:
+            return
+
+        self.counts = dict(self.render_stats.counters)
+        self.counts['queries'] = len(self.connection.queries) - self.starting_queries
+
+        exceeded = []
+        for limit in LIMITS:
+            if limit in self.limits and self.counts[limit[4:]] > self.limits[limit]:
+                exceeded.append("%s %d > %d" % (limit[4:], self.counts[limit[4:]], self.limits[limit]))
+        if exceeded:
+            raise AssertionError("uni_form render budget exceeded: %s" % ", ".join(exceeded))
+
+
+def assertUniFormBudget(using=DEFAULT_DB_ALIAS, **limits):
+    return UniFormBudget(using, **limits)
+
+
+class UniFormBudgetMixin(object):
+    """
+    `TestCase` mixin adding `self.assertUniFormBudget(**limits)`.
+    """
+    def assertUniFormBudget(self, using=DEFAULT_DB_ALIAS, **limits):
+        return UniFormBudget(using, **limits)
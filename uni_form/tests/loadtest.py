@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Concurrent end-to-end load harness. It drives the form pages of the test project,
+`uni_form/tests/views.py`, with several threads through the Django test client for a
+fixed duration, and reports throughput, latency percentiles and memory growth. It
+catches what microbenchmarks miss, like contention in template loading under threaded
+workers. Everything runs in process, no network is needed::
+
+    cd uni_form/tests
+    python loadtest.py --threads=8 --duration=10
+    python loadtest.py --threads=4 --duration=5 /loadtest/formset/
+"""
+import gc
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from django.conf import settings
+from django.test.client import Client
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+LOADTEST_PATHS = ('/loadtest/form/', '/loadtest/filter/', '/loadtest/layout/', '/loadtest/formset/')
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the `percent` percentile of `sorted_values`, using the nearest rank.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+def get_memory():
+    """
+    Returns the peak resident memory of the process in KB, where available, and the
+    number of objects tracked by the garbage collector.
+    """
+    gc.collect()
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss, len(gc.get_objects())
+
+
+def worker(paths, deadline, results, lock):
+    client = Client()
+    latencies = dict([(path, []) for path in paths])
+    errors = dict.fromkeys(paths, 0)
+    while time.time() < deadline:
+        for path in paths:
+            started = time.time()
+            try:
+                response = client.get(path)
+                failed = response.status_code != 200
+            except Exception:
+                failed = True
+            latencies[path].append(time.time() - started)
+            if failed:
+                errors[path] += 1
+
+    lock.acquire()
+    try:
+        for path in paths:
+            results[path]['latencies'].extend(latencies[path])
+            results[path]['errors'] += errors[path]
+    finally:
+        lock.release()
+
+
+def run_load(paths=LOADTEST_PATHS, threads=4, duration=10.0, warmup=True):
+    """
+    Requests every path in `paths` in turn from `threads` threads for `duration` seconds.
+    Returns a dictionary with `paths` results, holding `requests`, `errors`, `throughput`
+    in requests per second and `p50`, `p95` and `p99` latencies in milliseconds for every
+    path, `total_throughput` and `memory` growth: `max_rss_kb`, None if unknown, and
+    `gc_objects`.
+    """
+    if warmup:
+        client = Client()
+        for path in paths:
+            client.get(path)
+
+    results = dict([(path, {'latencies': [], 'errors': 0}) for path in paths])
+    lock = threading.Lock()
+    max_rss_before, objects_before = get_memory()
+
+    started = time.time()
+    deadline = started + duration
+    workers = [threading.Thread(target=worker, args=(paths, deadline, results, lock))
+        for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - started
+
+    max_rss_after, objects_after = get_memory()
+    max_rss_growth = None
+    if max_rss_before is not None:
+        max_rss_growth = max_rss_after - max_rss_before
+
+    report = {
+        'paths': {},
+        'total_throughput': 0.0,
+        'memory': {
+            'max_rss_kb': max_rss_growth,
+            'gc_objects': objects_after - objects_before,
+        },
+    }
+    for path in paths:
+        latencies = sorted(results[path]['latencies'])
+        throughput = len(latencies) / elapsed
+        report['paths'][path] = {
+            'requests': len(latencies),
+            'errors': results[path]['errors'],
+            'throughput': throughput,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+        }
+        report['total_throughput'] += throughput
+    return report
+
+def format_report(report):
+    lines = ["%-24s %9s %7s %9s %9s %9s %9s" % ('path', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for path in sorted(report['paths']):
+        result = report['paths'][path]
+        lines.append("%-24s %9d %7d %9.1f %9.2f %9.2f %9.2f" % (path, result['requests'], result['errors'],
+            result['throughput'], result['p50'], result['p95'], result['p99']))
+    lines.append("total throughput: %.1f req/s" % report['total_throughput'])
+
+    memory = report['memory']
+    if memory['max_rss_kb'] is not None:
+        lines.append("peak memory growth: %d KB" % memory['max_rss_kb'])
+    lines.append("gc tracked objects growth: %d" % memory['gc_objects'])
+    return '\n'.join(lines)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [path ...]")
+    parser.add_option('--threads', type='int', default=4, help='Number of threads, 4 by default.')
+    parser.add_option('--duration', type='float', default=10.0, help='Seconds to run for, 10 by default.')
+    options, paths = parser.parse_args()
+
+    settings.DEBUG = False
+    report = run_load(tuple(paths) or LOADTEST_PATHS, options.threads, options.duration)
+    print format_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,45 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import os
+import pstats
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import zlib
+from StringIO import StringIO
+
 from django import forms
 from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.forms.models import formset_factory
+from django.http import Http404, HttpRequest, HttpResponse
 from django.template import Context, Template, TemplateSyntaxError
 from django.template.loader import get_template_from_string
 from django.template.loader import render_to_string
 from django.middleware.csrf import _get_new_csrf_key
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
 from uni_form.helpers import FormHelper, FormHelpersException, Submit, Reset, Hidden, Button
 from uni_form.helpers import Layout, Fieldset, MultiField, Row, Column, HTML, ButtonHolder, Div
+from uni_form.layout import Conditional, Deferred, LargeChoiceField
+from uni_form.views import register_deferred, render_deferred
+from uni_form import dedup, fragments, metrics, stats
+from uni_form.middleware import RenderAccountingMiddleware, RenderDedupMiddleware
+from uni_form.serializers import SerializationError, dumps_helper, loads_helper, dumps_form_state
+from uni_form.serializers import serialize_layout, load_layout
+from uni_form.tests.budget import assertUniFormBudget
+from uni_form.tests.loadtest import run_load, format_report
+from uni_form.utils import fill_placeholders, get_placeholder_signature, get_snippet, get_static_field_attrs
+from uni_form.utils import pack_templates
 
 
 class TestForm(forms.Form):
@@ -31,6 +59,9 @@ class TestForm(forms.Form):
 
         return self.cleaned_data
 
+def is_company_form(form, context, user):
+    return bool(form['is_company'].value())
+
 class TestBasicFunctionalityTags(TestCase):
     def setUp(self):
         pass
@@ -93,6 +124,54 @@ class TestBasicFunctionalityTags(TestCase):
         self.assertTrue('form-INITIAL_FORMS' in html)
         self.assertTrue('form-MAX_NUM_FORMS' in html)
 
+    def test_as_uni_form_does_not_modify_widgets(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {{ form|as_uni_form }}
+        """)
+        form = TestForm()
+        form.fields['first_name'].widget.attrs['class'] = 'special'
+        c = Context({'form': form})
+        html = template.render(c)
+
+        self.assertFalse('class' in form.fields['email'].widget.attrs)
+        self.assertEqual(form.fields['first_name'].widget.attrs['class'], 'special')
+        self.assertTrue('class="ctrlHolder special"' in html)
+        self.assertTrue('class="ctrlHolder checkbox"' in html)
+        self.assertTrue('textInput' in html)
+        self.assertEqual(html, template.render(c))
+
+    def test_uni_fields_tag(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_fields form %}
+                <div class="passwords">{% uni_field password1 "password2" %}</div>
+                {% uni_field email %}
+                <div class="rest">{% uni_remaining_fields %}</div>
+            {% end_uni_fields %}
+        """)
+        c = Context({'form': TestForm()})
+        html = template.render(c)
+
+        self.assertEqual(html.count('<input'), 6)
+        self.assertEqual(html.count('id="id_email"'), 1)
+        self.assertTrue(html.index('id="id_password2"') < html.index('id="id_email"'))
+        self.assertTrue(html.index('class="rest"') < html.index('id="id_is_company"'))
+        self.assertEqual(len(c.dicts), 1)
+
+        # Form errors are rendered with the page context
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_fields form %}{% uni_errors %}{% uni_field email %}{% end_uni_fields %}
+        """)
+        form = TestForm({'password1': 'wargame', 'password2': 'god'})
+        form.is_valid()
+        c = Context({'form': form, 'form_error_title': 'Oops'})
+        html = template.render(c)
+        self.assertTrue('<h3>Oops</h3>' in html)
+        self.assertTrue("Passwords dont match" in html)
+        self.assertEqual(len(c.dicts), 1)
+
     def test_uni_form_setup(self):
         template = get_template_from_string("""
             {% load uni_form_tags %}
@@ -219,6 +298,62 @@ class TestFormHelpers(TestCase):
             self.assertRaises(TypeError, lambda:template.render(c))
         del settings.UNIFORM_FAIL_SILENTLY
 
+    def test_uni_form_formset_render_empty_form(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form testFormSet formset_helper %}
+        """)
+
+        form_helper = FormHelper()
+        form_helper.render_empty_form = True
+        form_helper.add_layout(Layout('email', 'first_name'))
+
+        TestFormSet = formset_factory(TestForm, extra=3)
+        formset = TestFormSet()
+        html = template.render(Context({'testFormSet': formset, 'formset_helper': form_helper}))
+
+        self.assertEqual(html.count('<template id="form-empty-form" class="emptyForm">'), 1)
+        self.assertEqual(html.count('id="id_form-__prefix__-email"'), 1)
+        self.assertFalse('id_form-0-email' in html)
+        self.assertTrue('name="form-TOTAL_FORMS" value="0"' in html)
+
+        # The formset is left as it was
+        self.assertEqual(formset.extra, 3)
+        self.assertEqual(len(formset.forms), 3)
+        self.assertFalse(hasattr(formset, 'empty_form_html'))
+        self.assertEqual(formset.management_form['TOTAL_FORMS'].value(), 3)
+        self.assertEqual(template.render(Context({'testFormSet': formset, 'formset_helper': form_helper})), html)
+
+        # Without a layout the empty form goes through uni_form.html
+        form_helper = FormHelper()
+        form_helper.render_empty_form = True
+        html = template.render(Context({'testFormSet': TestFormSet(), 'formset_helper': form_helper}))
+        self.assertEqual(html.count('id="id_form-__prefix__-email"'), 1)
+        self.assertFalse('id_form-0-email' in html)
+
+        # Bound formsets keep their forms
+        data = {'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '0', 'form-MAX_NUM_FORMS': ''}
+        html = template.render(Context({'testFormSet': TestFormSet(data), 'formset_helper': form_helper}))
+        self.assertTrue('id_form-0-email' in html)
+        self.assertEqual(html.count('id="id_form-__prefix__-email"'), 1)
+
+        # Layout snippets get the forloop of the form after the last one in the empty form
+        form_helper = FormHelper()
+        form_helper.render_empty_form = True
+        form_helper.add_layout(Layout(
+            HTML(u'<p class="item">{{ forloop.counter }}{% if forloop.first %} first{% endif %}'
+                 u'{% if forloop.last %} last{% endif %}</p>'),
+            HTML(u'{% if forloop.last %}<p class="last"></p>{% endif %}'),
+            'email',
+        ))
+        html = template.render(Context({'testFormSet': TestFormSet(data), 'formset_helper': form_helper}))
+        forms_html, empty_form_html = html.split('<template')
+        self.assertTrue('<p class="item">1 first last</p>' in forms_html)
+        self.assertTrue('<p class="item">2 last</p>' in empty_form_html)
+        self.assertTrue('<p class="last"></p>' in empty_form_html)
+        html = template.render(Context({'testFormSet': TestFormSet(), 'formset_helper': form_helper}))
+        self.assertTrue('<p class="item">1 first last</p>' in html.split('<template')[1])
+
     def test_uni_form_formset_with_helper_without_layout(self):
         template = get_template_from_string(u"""
             {% load uni_form_tags %}
@@ -278,6 +413,450 @@ class TestFormHelpers(TestCase):
         
         self.assertFalse("<input type='hidden' name='csrfmiddlewaretoken'" in html) 
 
+    def test_placeholders_two_phase_rendering(self):
+        form_helper = FormHelper()
+        form_helper.placeholders = ['username']
+        form_helper.add_layout(
+            Layout(
+                HTML("<p>Hello {{ username }}</p>"),
+                'email',
+            )
+        )
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+
+        token = _get_new_csrf_key()
+        c = Context({'form': TestForm(), 'form_helper': form_helper, 'csrf_token': token, 'username': 'john'})
+        html = template.render(c)
+
+        # First phase output doesn't hold any per-request value
+        self.assertFalse(token in html)
+        self.assertFalse('john' in html)
+        self.assertTrue("value='<!--uni_form:csrf_token:%s-->'" % get_placeholder_signature('csrf_token') in html)
+        self.assertTrue('<p>Hello <!--uni_form:username:%s--></p>' % get_placeholder_signature('username') in html)
+        self.assertEqual(len(c.dicts), 1)
+
+        html = fill_placeholders(html, Context({'csrf_token': token, 'username': '<b>paul</b>'}))
+        self.assertTrue("value='%s'" % token in html)
+        self.assertTrue('<p>Hello &lt;b&gt;paul&lt;/b&gt;</p>' in html)
+        self.assertFalse('uni_form:' in html)
+
+        # Markers not emitted by placeholders, like ones in unescaped content, are left alone
+        c = Context({'user': {'password': 'secret'}})
+        for marker in (u'<!--uni_form:user.password-->', u'<!--uni_form:user.password:0123456789abcdef-->'):
+            self.assertEqual(fill_placeholders(marker, c), marker)
+
+    def test_uni_form_fill_tag(self):
+        form_helper = FormHelper()
+        form_helper.placeholders = []
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form_fill %}{% uni_form form form_helper %}{% end_uni_form_fill %}
+        """)
+
+        token = _get_new_csrf_key()
+        c = Context({'form': TestForm(), 'form_helper': form_helper, 'csrf_token': token})
+        html = template.render(c)
+
+        self.assertTrue("<input type='hidden' name='csrfmiddlewaretoken' value='%s'" % token in html)
+        self.assertFalse('uni_form:' in html)
+
+    def test_render_accounting_middleware(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {{ form|as_uni_form }}
+            {% uni_form form form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(Layout(Fieldset('{{ title }}', 'email'), 'first_name'))
+
+        middleware = RenderAccountingMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        html = template.render(Context({'form': TestForm(), 'form_helper': form_helper, 'title': 'Title'}))
+        response = middleware.process_response(request, HttpResponse(html))
+
+        render_stats = request.uni_form_stats
+        self.assertEqual(render_stats['renders'], 2)
+        self.assertEqual(render_stats['fields'], 12)
+        self.assertEqual(render_stats['contexts'], 1)
+        self.assertTrue(render_stats['template_loads'] + render_stats['template_cache_hits'] > 0)
+        self.assertTrue(render_stats['bytes'] > 0)
+        self.assertTrue(response['Server-Timing'].startswith('uniform;dur='))
+        self.assertTrue('renders=2 fields=12' in response['Server-Timing'])
+
+        # Nothing is collected once the response is processed
+        template.render(Context({'form': TestForm(), 'form_helper': form_helper, 'title': 'Title'}))
+        self.assertEqual(render_stats['renders'], 2)
+
+    def test_render_metrics(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form formset form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.form_id = 'test-formset'
+        form_helper.add_layout(Layout(Fieldset('Item', 'email'), 'first_name'))
+        TestFormSet = formset_factory(TestForm, extra=2)
+        context = Context({'formset': TestFormSet(), 'form_helper': form_helper})
+
+        sink = metrics.MemorySink()
+        metrics.set_sink(sink)
+        try:
+            settings.UNIFORM_METRICS_SAMPLE_RATE = 0
+            template.render(context)
+            self.assertEqual(sink.metrics, [])
+
+            settings.UNIFORM_METRICS_SAMPLE_RATE = 1
+            template.render(context)
+        finally:
+            metrics.set_sink(None)
+            del settings.UNIFORM_METRICS_SAMPLE_RATE
+
+        names = sink.names()
+        self.assertEqual(names.count('uni_form.render'), 1)
+        self.assertEqual(names.count('uni_form.render_layout'), 2)
+        self.assertEqual(names.count('uni_form.fields'), 2)
+        self.assertEqual(names.count('uni_form.render_field'), 14)
+
+        kind, name, value, tags, sample_rate = sink.metrics[-1]
+        self.assertEqual((kind, name), ('timing', 'uni_form.render'))
+        self.assertEqual(tags, {'form': 'TestFormFormSet', 'helper': 'test-formset', 'formset_size': 2})
+        self.assertTrue(('counter', 'uni_form.fields', 6, {'form': 'TestForm', 'helper': 'test-formset'}, 1)
+            in sink.metrics)
+
+    def test_statsd_metrics_sink(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        sink = metrics.StatsdSink('127.0.0.1', listener.getsockname()[1])
+        try:
+            sink.timing('uni_form.render', 1.5, {'form': 'TestForm', 'formset_size': 2}, 0.5)
+            self.assertEqual(listener.recv(1024), 'uni_form.render:1.500|ms|@0.5|#form:TestForm,formset_size:2')
+            sink.incr('uni_form.fields', 6, {}, 1)
+            self.assertEqual(listener.recv(1024), 'uni_form.fields:6|c')
+        finally:
+            listener.close()
+
+    def test_render_trace(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                MultiField("Company", 'is_company', 'email', css_id='multifield_company'),
+                HTML('<p>Traced {{ form.prefix }}</p>'),
+                'first_name',
+            )
+        )
+
+        trace_dir = tempfile.mkdtemp()
+        settings.UNIFORM_TRACE_DIR = trace_dir
+        settings.DEBUG = True
+        try:
+            template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+            file_names = os.listdir(trace_dir)
+            self.assertEqual(len(file_names), 1)
+            self.assertTrue(file_names[0].startswith('uni_form-TestForm-'))
+            trace = simplejson.load(open(os.path.join(trace_dir, file_names[0])))
+        finally:
+            settings.DEBUG = False
+            del settings.UNIFORM_TRACE_DIR
+            shutil.rmtree(trace_dir)
+
+        events = trace['traceEvents']
+        names = [event['name'] for event in events]
+        self.assertEqual(names[0], 'uni_form')
+        self.assertTrue('Layout' in names)
+        self.assertTrue('MultiField: Company' in names)
+        self.assertTrue('HTML: <p>Traced {{ form.prefix }}</p>' in names)
+        self.assertTrue('field: email' in names)
+        self.assertTrue('load: uni_form/layout/multifield.html' in names)
+        self.assertTrue('compile' in names)
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertTrue(event['ts'] >= events[0]['ts'])
+
+        multifield = events[names.index('MultiField: Company')]
+        self.assertEqual(multifield['args']['css_id'], 'multifield_company')
+        email = events[names.index('field: email')]
+        self.assertTrue(multifield['ts'] <= email['ts'])
+        self.assertTrue(email['ts'] + email['dur'] <= multifield['ts'] + multifield['dur'])
+
+    def test_render_budget(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(Layout(Fieldset('Contact', 'email'), HTML('<hr />'), 'first_name'))
+        context = Context({'form': TestForm(), 'form_helper': form_helper})
+        template.render(context)
+
+        with assertUniFormBudget(max_renders=1, max_fields=6, max_template_loads=0, max_compilations=0,
+            max_contexts=0, max_queries=0) as budget:
+            template.render(context)
+        self.assertEqual(budget.counts['fields'], 6)
+        self.assertTrue(budget.counts['bytes'] > 0)
+
+        try:
+            with assertUniFormBudget(max_fields=5, max_queries=0):
+                template.render(context)
+        except AssertionError, e:
+            self.assertEqual(str(e), "uni_form render budget exceeded: fields 6 > 5")
+        else:
+            self.fail("Render budget was not enforced")
+
+        self.assertRaises(TypeError, assertUniFormBudget, max_templates=1)
+
+    def test_fragment_store(self):
+        # The budget is the memory fragments take
+        size = sys.getsizeof(u'a' * 40)
+        store = fragments.FragmentStore(max_bytes=2 * size + 60, compress_threshold=60)
+        store.set('a', u'a' * 40)
+        store.set('b', u'b' * 40)
+        self.assertEqual(store.get('a'), u'a' * 40)
+        # 'b' is the least recently used one
+        store.set('c', u'c' * 40)
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('c'), u'c' * 40)
+        # Too big fragments are not kept
+        store.set('d', u''.join([unichr(i) for i in range(256, 1256)]))
+        self.assertEqual(store.get('d'), None)
+
+        text = u'\xf1' * 200
+        store.set('e', text)
+        self.assertEqual(store.get('e'), text)
+        self.assertEqual(store.stats(), {'hits': 3, 'misses': 2, 'evictions': 1, 'entries': 3,
+            'compressed': 1, 'bytes': 2 * size + sys.getsizeof(zlib.compress(text.encode('utf-8')))})
+
+        # Segments are kept as they are
+        store.clear()
+        self.assertEqual(store.stats()['entries'], 0)
+        segments = (u'<p>', u'\x00uni_form:widget_html\x00', u'</p>')
+        store.set('f', segments)
+        self.assertTrue(store.get('f') is segments)
+        self.assertEqual(store.stats()['bytes'], sys.getsizeof(segments) + sum(map(sys.getsizeof, segments)))
+
+        # Layout field templates are kept in the store in use
+        store = fragments.FragmentStore()
+        fragments.set_store(store)
+        try:
+            form_helper = FormHelper()
+            form_helper.add_layout(Layout('email', 'first_name'))
+            template = get_template_from_string(u"""
+                {% load uni_form_tags %}
+                {% uni_form form form_helper %}
+            """)
+            html = template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+            self.assertEqual(store.stats()['misses'], 6)
+            self.assertEqual(template.render(Context({'form': TestForm(), 'form_helper': form_helper})), html)
+            self.assertEqual(store.stats()['hits'], 6)
+        finally:
+            fragments.set_store(None)
+
+    def test_mapped_fragment_store(self):
+        store_dir = tempfile.mkdtemp()
+        path = os.path.join(store_dir, 'fragments')
+        store = fragments.MappedFragmentStore(path, max_bytes=1024, compress_threshold=100, generation='1')
+        try:
+            # Fragments stored by other processes are read
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    child_store = fragments.MappedFragmentStore(path, max_bytes=1024, compress_threshold=100,
+                        generation='1')
+                    child_store.set(('field', TestForm, u'email'), u'<input name="email" />')
+                    child_store.set(('field', TestForm, u'notes'), u'\xf1' * 200)
+                    child_store.set(('field', TestForm, u'name'), (u'<p>\xf1', u'\x00uni_form:field\x00', u''))
+                    status = 0
+                finally:
+                    os._exit(status)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(store.get(('field', TestForm, u'email')), u'<input name="email" />')
+            self.assertEqual(store.get(('field', TestForm, u'notes')), u'\xf1' * 200)
+            self.assertEqual(store.get(('field', TestForm, u'name')), (u'<p>\xf1', u'\x00uni_form:field\x00', u''))
+            self.assertEqual(store.get(('field', TestForm, u'first_name')), None)
+            stats = store.stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['compressed']), (3, 1, 3, 1))
+
+            # When the data region is full the store is emptied
+            for i in range(10):
+                store.set(('fragment', i), u'x' * 99)
+            stats = store.stats()
+            self.assertEqual((stats['entries'], stats['evictions']), (5, 8))
+            self.assertEqual(store.get(('fragment', 9)), u'x' * 99)
+
+            # Keys are compared in full, classes by module and name
+            self.assertEqual(fragments.get_key_text(('field', TestForm, u'\xf1', 1, None)),
+                "('field',<uni_form.tests.tests.TestForm>,'\\xf1',1,None)")
+            self.assertEqual(store.get(('field', 'TestForm', u'email')), None)
+            self.assertRaises(TypeError, store.get, ('field', object()))
+
+            # Files created with another size are not resized
+            self.assertRaises(ImproperlyConfigured, fragments.MappedFragmentStore, path, max_bytes=2048)
+            self.assertEqual(store.get(('fragment', 9)), u'x' * 99)
+
+            # Opening the store with a new generation invalidates it
+            new_store = fragments.MappedFragmentStore(path, max_bytes=1024, compress_threshold=100, generation='2')
+            self.assertEqual(new_store.get(('fragment', 9)), None)
+            new_store.set(('fragment', 1), u'new')
+            self.assertEqual(new_store.get(('fragment', 1)), u'new')
+            # Processes of the old generation don't read or write anymore
+            store.set(('fragment', 2), u'old')
+            self.assertEqual(store.get(('fragment', 1)), None)
+            self.assertEqual(new_store.get(('fragment', 2)), None)
+            new_store.close()
+        finally:
+            store.close()
+            shutil.rmtree(store_dir)
+
+    def test_render_dedup_middleware(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            <header>{% uni_form form form.helper %}</header>
+            <footer>{% uni_form form form.helper %}</footer>
+            <aside>{{ form|as_uni_form }}{{ form|as_uni_form }}</aside>
+        """)
+
+        class HelperForm(TestForm):
+            @property
+            def helper(self):
+                form_helper = FormHelper()
+                form_helper.form_id = 'search'
+                form_helper.add_layout(Layout(Fieldset('{{ title }}', 'email'), 'first_name'))
+                return form_helper
+
+        middleware = RenderDedupMiddleware()
+        request = RequestFactory().get('/')
+        form = HelperForm()
+        render_stats = stats.start_collecting()
+        middleware.process_request(request)
+        try:
+            html = template.render(Context({'form': form, 'title': 'Search'}))
+        finally:
+            middleware.process_response(request, HttpResponse())
+            stats.stop_collecting(render_stats)
+
+        self.assertEqual(render_stats['renders'], 4)
+        # Fields are rendered by the first tag and the first filter only
+        self.assertEqual(render_stats['fields'], 12)
+        header, footer = html.split('<footer>')
+        self.assertTrue('<form class="uniForm" method="post" id="search">' in header)
+        self.assertTrue('<form class="uniForm" method="post" id="search_2">' in footer)
+        self.assertTrue('for="id_email_2"' in footer and 'id="id_email_2"' in footer)
+        self.assertTrue('name="email"' in footer)
+        self.assertEqual(html.count('id="id_email_2"'), 2)
+
+        # Renders depending on different context inputs are not deduplicated
+        middleware.process_request(request)
+        try:
+            html = get_template_from_string(u"""
+                {% load uni_form_tags %}
+                {% uni_form form form.helper %}
+                {% with "Other" as title %}{% uni_form form form.helper %}{% endwith %}
+            """).render(Context({'form': form, 'title': 'Search'}))
+        finally:
+            middleware.process_response(request, HttpResponse())
+        self.assertTrue('<legend>Other</legend>' in html)
+        self.assertFalse('id_email_2' in html)
+
+        # Nor renders of layout objects with templates using other context inputs
+        class CustomHelperForm(TestForm):
+            helper = FormHelper()
+            helper.add_layout(Layout(Div('email', template='custom_div.html')))
+
+        middleware.process_request(request)
+        try:
+            html = get_template_from_string(u"""
+                {% load uni_form_tags %}
+                {% uni_form form form.helper %}
+                {% with "Second note" as page_note %}{% uni_form form form.helper %}{% endwith %}
+            """).render(Context({'form': CustomHelperForm(), 'page_note': 'First note'}))
+        finally:
+            middleware.process_response(request, HttpResponse())
+        self.assertTrue('<div class="custom">First note' in html)
+        self.assertTrue('<div class="custom">Second note' in html)
+        self.assertFalse('id_email_2' in html)
+
+        # Nor formsets rendering their empty form, whose add form buttons find it by id
+        formset_helper = FormHelper()
+        formset_helper.render_empty_form = True
+        formset_template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form formset helper %}{% uni_form formset helper %}
+        """)
+        middleware.process_request(request)
+        try:
+            formset = formset_factory(TestForm, extra=1)()
+            html = formset_template.render(Context({'formset': formset, 'helper': formset_helper}))
+            self.assertEqual(html.count('<template id="form-empty-form"'), 2)
+            self.assertEqual(html.count('id="id_form-TOTAL_FORMS"'), 2)
+            self.assertFalse('_2"' in html)
+
+            # Other formsets are deduplicated
+            html = formset_template.render(Context({'formset': formset, 'helper': FormHelper()}))
+            self.assertTrue('id="id_form-0-email_2"' in html)
+        finally:
+            middleware.process_response(request, HttpResponse())
+
+        # Renders are dropped when the view raises
+        middleware.process_request(request)
+        middleware.process_exception(request, ValueError())
+        self.assertFalse(dedup.is_on())
+
+        # Nothing is deduplicated outside of requests going through the middleware
+        html = template.render(Context({'form': form, 'title': 'Search'}))
+        self.assertFalse('id_email_2' in html)
+
+        # Helpers built by form properties are built once per render
+        class CountingHelperForm(TestForm):
+            helpers = 0
+            @property
+            def helper(self):
+                CountingHelperForm.helpers += 1
+                return FormHelper()
+
+        template = get_template_from_string(u"{% load uni_form_tags %}{% uni_form form form.helper %}")
+        template.render(Context({'form': CountingHelperForm()}))
+        self.assertEqual(CountingHelperForm.helpers, 1)
+
+    def test_uniform_profile_command(self):
+        profile_dir = tempfile.mkdtemp()
+        prof_file = os.path.join(profile_dir, 'form.prof')
+        output = StringIO()
+        try:
+            call_command('uniform_profile', 'uni_form.tests.tests.TestForm', renders=3, formset=2,
+                top=5, prof_file=prof_file, stdout=output)
+            # Formsets are built outside of the profiler
+            profiled = [function[2] for function in pstats.Stats(prof_file).stats]
+            self.assertTrue('render' in profiled)
+            self.assertFalse('_construct_forms' in profiled)
+        finally:
+            shutil.rmtree(profile_dir)
+
+        output = output.getvalue()
+        self.assertTrue(output.startswith('3 renders of uni_form.tests.tests.TestForm'))
+        # 2 forms and the 3 management form fields
+        self.assertTrue('fields per render: 15.0' in output)
+        self.assertTrue('forms built beforehand in' in output)
+        self.assertTrue('Top functions:' in output)
+
+    def test_load_harness(self):
+        report = run_load(('/loadtest/layout/', '/loadtest/formset/'), threads=2, duration=0.2)
+        for path in ('/loadtest/layout/', '/loadtest/formset/'):
+            result = report['paths'][path]
+            self.assertTrue(result['requests'] > 0)
+            self.assertEqual(result['errors'], 0)
+            self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+        self.assertTrue('total throughput' in format_report(report))
+
+
 class TestFormLayout(TestCase):
     urls = 'uni_form.tests.urls'
     def test_layout_invalid_unicode_characters(self):
@@ -514,6 +1093,248 @@ class TestFormLayout(TestCase):
         html = template.render(c)
         self.assertFalse('email' in html)
 
+    def test_change_layout_dynamically_by_key(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        layout = Layout(
+            Fieldset(
+                u'Company Data',
+                'is_company',
+                'email',
+                css_id = "fieldset_company",
+            ),
+            Column(
+                'first_name',
+                'last_name',
+                css_id = "column_name",
+            )
+        )
+        form_helper = FormHelper()
+        form_helper.add_layout(layout)
+
+        self.assertEqual(layout.get_node('fieldset_company'), layout.fields[0])
+        self.assertEqual(layout.remove('email'), 'email')
+        html_node = HTML('<p id="before-first-name"></p>')
+        layout.insert_before('first_name', html_node)
+        layout.insert_after('is_company', 'password1')
+        div = layout.wrap('last_name', Div, css_id='wrapped-last-name')
+        layout.replace('fieldset_company', Fieldset(u'Passwords', 'password1', 'password2'))
+
+        self.assertEqual(layout.get_node('wrapped-last-name'), div)
+        self.assertEqual(layout.fields[1].fields, [html_node, 'first_name', div])
+        self.assertEqual(div.fields, ['last_name'])
+        self.assertRaises(KeyError, lambda: layout.get_node('is_company'))
+
+        # Nodes moved by the API are found without rebuilding the index
+        rebuilds = []
+        layout._build_index = lambda: rebuilds.append(1) or Layout._build_index(layout)
+        layout.insert_before('column_name', HTML('<hr>'))
+        self.assertEqual(layout.get_node('last_name'), 'last_name')
+        self.assertEqual(layout.get_node('password2'), 'password2')
+        self.assertEqual(rebuilds, [])
+
+        # Changing `fields` directly is still supported
+        layout.fields.append(Div('email', css_id='email-div'))
+        self.assertEqual(layout.get_node('email'), 'email')
+        email_div = layout.fields.pop()
+        self.assertRaises(KeyError, lambda: layout.get_node('email'))
+        self.assertRaises(KeyError, lambda: layout.insert_after('email', 'password2'))
+        self.assertEqual(email_div.fields, ['email'])
+        layout.fields.append(email_div)
+
+        form = TestForm()
+        html = template.render(Context({'form': form, 'form_helper': form_helper}))
+        self.assertTrue('Passwords' in html)
+        self.assertFalse('Company Data' in html)
+        self.assertEqual(html.count('id="id_password1"'), 1)
+        self.assertTrue(html.index('before-first-name') < html.index('id="id_first_name"'))
+        self.assertTrue(html.index('id="wrapped-last-name"') < html.index('id="id_last_name"'))
+
+    def test_conditional_layout(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+
+        class User(object):
+            def __init__(self, is_staff):
+                self.is_staff = is_staff
+
+        class Request(object):
+            def __init__(self, user):
+                self.user = user
+
+        calls = []
+        def is_staff(form, context, user):
+            calls.append(form)
+            return user is not None and user.is_staff
+
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                Conditional(is_staff,
+                    Fieldset('Moderation', 'email', Div('password1', css_id='passwords')),
+                ),
+                'first_name',
+            )
+        )
+
+        form = TestForm()
+        html = template.render(Context({'form': form, 'form_helper': form_helper, 'user': User(False)}))
+        self.assertEqual(calls, [form])
+        self.assertFalse('Moderation' in html)
+        self.assertFalse('id_email' in html)
+        self.assertFalse('id_password1' in html)
+        self.assertTrue('id_first_name' in html)
+        self.assertTrue('id_password2' in html)
+        self.assertEqual(form.omitted_fields, ['email', 'password1'])
+
+        form = TestForm()
+        html = template.render(Context({'form': form, 'form_helper': form_helper, 'request': Request(User(True))}))
+        self.assertTrue('Moderation' in html)
+        self.assertTrue('id_email' in html)
+        self.assertTrue('id_password1' in html)
+        self.assertEqual(form.omitted_fields, [])
+
+        # Fields within can be found by the layout API
+        self.assertEqual(form_helper.layout.get_node('passwords').fields, ['password1'])
+
+    def test_deferred_layout(self):
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                Deferred('test_deferred', Fieldset('Passwords', 'password1', 'password2', css_id='passwords')),
+                'email',
+            )
+        )
+        def factory(request):
+            return TestForm(initial={'password1': request.GET.get('password')}), form_helper
+        register_deferred('test_deferred', factory)
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form = TestForm()
+        html = template.render(Context({'form': form, 'form_helper': form_helper}))
+        self.assertTrue('Passwords' in html)
+        self.assertTrue('data-deferred-url="/uni_form/deferred/test_deferred/passwords/"' in html)
+        self.assertFalse('id_password1' in html)
+        self.assertFalse('id_password2' in html)
+        self.assertTrue('id_email' in html)
+        self.assertTrue('id_first_name' in html)
+        self.assertEqual(form.deferred_fields, ['password1', 'password2'])
+
+        response = self.client.get('/uni_form/deferred/test_deferred/passwords/', {'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('<fieldset id="passwords"' in response.content)
+        self.assertTrue('id_password1' in response.content)
+        self.assertTrue('id_password2' in response.content)
+        self.assertFalse('id_email' in response.content)
+
+        request = RequestFactory().get('/')
+        self.assertRaises(Http404, render_deferred, request, 'test_deferred', 'email')
+        self.assertRaises(Http404, render_deferred, request, 'unknown', 'passwords')
+
+    def test_large_choice_field(self):
+        class CityForm(forms.Form):
+            city = forms.ChoiceField(choices=[(str(i), 'City %d' % i) for i in range(1000)])
+            group = forms.ModelChoiceField(queryset=Group.objects.order_by('name'), required=False)
+
+        for name in ('Admins', 'Editors', 'Writers'):
+            Group.objects.create(name=name)
+        editors = Group.objects.get(name='Editors')
+
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                LargeChoiceField('city', 'test_choices', page_size=5),
+                LargeChoiceField('group', 'test_choices', search_fields=['name__icontains'], page_size=1),
+            )
+        )
+        register_deferred('test_choices', lambda request: (CityForm(), form_helper))
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form = CityForm({'city': '500', 'group': str(editors.pk)})
+        html = template.render(Context({'form': form, 'form_helper': form_helper}))
+        self.assertFalse('<option' in html)
+        self.assertTrue('name="city"' in html)
+        self.assertTrue('value="500"' in html)
+        self.assertTrue('value="City 500"' in html)
+        self.assertTrue('value="Editors"' in html)
+        self.assertTrue('data-choices-url="/uni_form/choices/test_choices/city/"' in html)
+        self.assertTrue(form.is_valid())
+        self.assertFalse(CityForm({'city': '1000'}).is_valid())
+
+        response = self.client.get('/uni_form/choices/test_choices/city/', {'q': 'city 12', 'page': 2})
+        data = simplejson.loads(response.content)
+        self.assertEqual(data['page'], 2)
+        self.assertTrue(data['has_next'])
+        self.assertEqual([choice['label'] for choice in data['results']],
+            ['City 124', 'City 125', 'City 126', 'City 127', 'City 128'])
+
+        response = self.client.get('/uni_form/choices/test_choices/group/', {'q': 'it'})
+        data = simplejson.loads(response.content)
+        self.assertEqual(data['results'], [{'value': str(editors.pk), 'label': 'Editors'}])
+        self.assertTrue(data['has_next'])
+
+    def test_specialized_field_rendering(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+
+        def render(form):
+            form_helper = FormHelper()
+            form_helper.add_layout(
+                Layout(
+                    MultiField("Company", 'is_company', 'email'),
+                    'first_name',
+                )
+            )
+            return template.render(Context({'form': form, 'form_helper': form_helper}))
+
+        # Field templates are not specialized in DEBUG mode
+        settings.DEBUG = True
+        try:
+            html_debug = render(TestForm({'email': 'john@example.com'}))
+        finally:
+            settings.DEBUG = False
+
+        render(TestForm())
+        self.assertEqual(render(TestForm({'email': 'john@example.com'})), html_debug)
+
+        # Changes to form instance fields are taken into account
+        form = TestForm()
+        form.fields['first_name'].label = 'Given name'
+        form.fields['first_name'].widget = forms.Textarea()
+        html = render(form)
+        self.assertTrue('Given name' in html)
+        self.assertTrue('<textarea' in html)
+        self.assertFalse('Given name' in render(TestForm()))
+
+        # Pages with autoescaping off don't change the output of the others
+        class AmpForm(TestForm):
+            def __init__(self, *args, **kwargs):
+                super(AmpForm, self).__init__(*args, **kwargs)
+                self.fields['first_name'].widget.attrs['class'] = 'given&name'
+
+        form_helper = FormHelper()
+        form_helper.add_layout(Layout('first_name'))
+        html = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% autoescape off %}{% uni_form form form_helper %}{% endautoescape %}
+        """).render(Context({'form': AmpForm(), 'form_helper': form_helper}))
+        self.assertTrue('given&name' in html)
+        html = template.render(Context({'form': AmpForm(), 'form_helper': form_helper}))
+        self.assertTrue('given&amp;name' in html)
+        self.assertFalse('given&name' in html)
+
     def test_formset_layout(self):
         template = get_template_from_string(u"""
             {% load uni_form_tags %}
@@ -566,6 +1387,90 @@ class TestFormLayout(TestCase):
         self.assertEqual(html.count('Note for first form only'), 1)
         self.assertEqual(html.count('formRow'), 3)
 
+    def test_formset_layout_snippets_rendered_once(self):
+        class Counter(object):
+            count = 0
+            def value(self):
+                self.count += 1
+                return self.count
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form testFormSet formset_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                Fieldset("Legend {{ counter.value }}", 'email'),
+                HTML("{% if forloop.first %}First form{% endif %}{% if forloop.last %}Last form{% endif %}"),
+                HTML("Form {{ forloop.counter }}"),
+            )
+        )
+        TestFormSet = formset_factory(TestForm, extra = 3)
+        counter = Counter()
+        c = Context({'testFormSet': TestFormSet(), 'formset_helper': form_helper, 'counter': counter})
+        html = template.render(c)
+
+        # `counter.value` is a call, so the legend is rendered for every form
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(html.count('Legend 1'), 1)
+        self.assertEqual(html.count('Legend 3'), 1)
+        self.assertEqual(html.count('First form'), 1)
+        self.assertEqual(html.count('Last form'), 1)
+        self.assertTrue(html.index('First form') < html.index('Form 1') < html.index('Form 3'))
+        self.assertTrue(html.index('Form 2') < html.index('Last form') < html.index('Form 3'))
+
+    def test_formset_pure_snippets_rendered_once(self):
+        class Labels(dict):
+            lookups = 0
+            def __getitem__(self, key):
+                self.lookups += 1
+                return dict.__getitem__(self, key)
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form testFormSet formset_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                Fieldset("{{ labels.legend|upper }}", 'email'),
+                HTML("{% for letter in labels.legend %}{{ letter }}{% endfor %}!"),
+            )
+        )
+        TestFormSet = formset_factory(TestForm, extra = 3)
+        labels = Labels(legend='contact')
+        c = Context({'testFormSet': TestFormSet(), 'formset_helper': form_helper, 'labels': labels})
+        html = template.render(c)
+
+        self.assertEqual(html.count('CONTACT'), 3)
+        self.assertEqual(html.count('contact!'), 3)
+        # The legend is checked and rendered once, the loop is rendered every time
+        self.assertEqual(labels.lookups, 2 + 3)
+        self.assertEqual(get_snippet("{% load uni_form_field %}{{ field|with_class }}").dependency, 'dynamic')
+
+    def test_layout_shares_page_context(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% autoescape off %}{% uni_form testFormSet formset_helper %}{% endautoescape %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(
+            Layout(
+                Div('email', css_class="<b>"),
+                HTML("{{ forloop.counter }}-{{ page_var }}"),
+            )
+        )
+        TestFormSet = formset_factory(TestForm, extra = 2)
+        c = Context({'testFormSet': TestFormSet(), 'formset_helper': form_helper, 'page_var': 'page'})
+        html = template.render(c)
+
+        # Layout templates are rendered with the page context and its autoescape setting
+        self.assertTrue('class="<b>"' in html)
+        self.assertTrue('1-page' in html)
+        self.assertTrue('2-page' in html)
+        self.assertEqual(len(c.dicts), 1)
+
     def test_i18n(self):
         template = get_template_from_string(u"""
             {% load uni_form_tags %}
@@ -584,3 +1489,275 @@ class TestFormLayout(TestCase):
         form.helper = form_helper
 
         html = template.render(Context({'form': form}))
+
+    def test_i18n_lazy_layout(self):
+        from django.utils import translation
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.layout = Layout(
+            HTML(_("Yes")),
+            Fieldset(_("Yes"), 'first_name'),
+            MultiField(_("Yes"), 'last_name'),
+        )
+
+        translation.activate('es')
+        html = template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+        translation.activate('fr')
+        html_fr = template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+        translation.deactivate()
+
+        self.assertEqual(html.count(u'Sí'), 3)
+        self.assertEqual(html_fr.count(u'Oui'), 3)
+
+    def test_template_packs(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        form_helper = FormHelper()
+        form_helper.add_layout(Layout(Fieldset('Contact', 'email'), Div('first_name')))
+
+        html = template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+        self.assertFalse('packField' in html)
+
+        # Templates the pack doesn't have are taken from uni_form
+        form_helper.template_pack = 'test_pack'
+        html = template.render(Context({'form': TestForm(), 'form_helper': form_helper}))
+        self.assertEqual(html.count('class="packField"'), 6)
+        self.assertTrue('<section class="packFieldset"><h2>Contact</h2>' in html)
+        self.assertTrue('<div id="div_id_first_name"' not in html)
+        self.assertTrue('<div' in html and '<form' in html)
+
+        # The pack can be selected per request in the context
+        form_helper.template_pack = None
+        html = template.render(Context({'form': TestForm(), 'form_helper': form_helper,
+            'uni_form_template_pack': 'test_pack'}))
+        self.assertEqual(html.count('class="packField"'), 6)
+        self.assertEqual(template.render(Context({'form': TestForm(), 'form_helper': form_helper})).count('packField'), 0)
+
+        # Forms rendered without a layout use the pack templates too
+        html = template.render(Context({'form': TestForm(), 'form_helper': FormHelper(),
+            'uni_form_template_pack': 'test_pack'}))
+        self.assertEqual(html.count('class="packField"'), 6)
+
+        # Or for the whole site, filters included
+        settings.UNIFORM_TEMPLATE_PACK = 'test_pack'
+        try:
+            filter_template = get_template_from_string(u"{% load uni_form_tags %}{{ form.email|as_uni_field }}")
+            self.assertTrue(filter_template.render(Context({'form': TestForm()})).startswith('\n\n<p class="packField">'))
+            filter_template = get_template_from_string(u"{% load uni_form_tags %}{{ form|as_uni_form }}")
+            self.assertEqual(filter_template.render(Context({'form': TestForm()})).count('class="packField"'), 6)
+        finally:
+            del settings.UNIFORM_TEMPLATE_PACK
+
+        self.assertEqual(pack_templates[('test_pack', 'uni_form/field.html')], 'test_pack/field.html')
+        self.assertEqual(pack_templates[('test_pack', 'uni_form/layout/div.html')], 'uni_form/layout/div.html')
+
+    def test_field_memo(self):
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+
+        def render(data):
+            form_helper = FormHelper()
+            form_helper.add_layout(Layout(MultiField('Company', 'is_company'), 'email', 'first_name'))
+            return template.render(Context({'form': TestForm(data), 'form_helper': form_helper}))
+
+        def memoized():
+            return len([key for key in store.entries if isinstance(key, basestring)])
+
+        data = {'email': 'invalid', 'first_name': 'Miguel', 'password1': 'a', 'password2': 'b'}
+        html = render(data)
+        store = fragments.FragmentStore()
+        fragments.set_store(store)
+        settings.UNIFORM_FIELD_MEMO = 'fragments'
+        try:
+            self.assertEqual(render(data), html)
+            self.assertEqual(memoized(), 6)
+            hits = store.stats()['hits']
+            self.assertEqual(render(data), html)
+            self.assertEqual(store.stats()['hits'], hits + 6)
+
+            # Only fields whose value changes are rendered again
+            data['first_name'] = 'Daniel'
+            html = render(data)
+            self.assertTrue('value="Daniel"' in html)
+            self.assertEqual(memoized(), 7)
+
+            # Fields are memoized per language, with their choices translated
+            from django.utils import translation
+            class ChoiceForm(forms.Form):
+                answer = forms.ChoiceField(choices=[('y', _('Yes')), ('n', _('No'))])
+                group = forms.ModelChoiceField(queryset=Group.objects.all())
+
+            Group.objects.create(name='Editors')
+            form_helper = FormHelper()
+            form_helper.add_layout(Layout('answer', 'group'))
+            choice_context = lambda: Context({'form': ChoiceForm(), 'form_helper': form_helper})
+            translation.activate('es')
+            try:
+                self.assertTrue(u'S\xed' in template.render(choice_context()))
+                memoized_es = memoized()
+            finally:
+                translation.activate('en')
+            try:
+                html_en = template.render(choice_context())
+                self.assertTrue(u'>Yes<' in html_en and u'S\xed' not in html_en)
+                self.assertEqual(memoized(), memoized_es + 1)
+                # Model choice fields are not memoized, their queries run once per render
+                self.assertNumQueries(1, lambda: self.assertEqual(template.render(choice_context()), html_en))
+                self.assertEqual(memoized(), memoized_es + 1)
+            finally:
+                translation.deactivate()
+
+            # Fields are memoized per autoescaping too
+            form = TestForm(data)
+            form.fields['email'].widget.attrs['class'] = 'e&mail'
+            form_helper = FormHelper()
+            form_helper.add_layout(Layout('email'))
+            unescaped_html = get_template_from_string(u"""
+                {% load uni_form_tags %}
+                {% autoescape off %}{% uni_form form form_helper %}{% endautoescape %}
+            """).render(Context({'form': form, 'form_helper': form_helper}))
+            self.assertTrue('e&mail' in unescaped_html)
+            escaped_html = template.render(Context({'form': form, 'form_helper': form_helper}))
+            self.assertTrue('e&amp;mail' in escaped_html and 'e&mail' not in escaped_html)
+
+            # Any cache can be used
+            settings.UNIFORM_FIELD_MEMO = 'default'
+            self.assertEqual(render(data), html)
+            self.assertEqual(render(data), html)
+        finally:
+            del settings.UNIFORM_FIELD_MEMO
+            fragments.set_store(None)
+
+    def test_lean_template_pack(self):
+        fields = {}
+        for i in range(50):
+            fields['text_%d' % i] = forms.CharField(label='Text %d' % i, help_text='Hint %d' % i)
+            fields['check_%d' % i] = forms.BooleanField(label='Check %d' % i, required=False)
+        BigForm = type('BigForm', (forms.Form,), fields)
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+
+        def render(template_pack):
+            form_helper = FormHelper()
+            form_helper.template_pack = template_pack
+            form_helper.add_layout(Layout(
+                Fieldset('Texts', *['text_%d' % i for i in range(25)]),
+                MultiField('Checks', *['check_%d' % i for i in range(25)]),
+                Div(*['text_%d' % i for i in range(25, 50)]),
+            ))
+            return template.render(Context({'form': BigForm({'text_0': 'x'}), 'form_helper': form_helper}))
+
+        html = render(None)
+        lean_html = render('uni_form_lean')
+
+        # The same fields, CSS hooks, errors and hints, in less markup
+        for bit in ('name="text_49"', 'name="check_49"', 'class="ctrlHolder error"', 'class="errorField"',
+                'class="formHint"', 'class="multiField"', 'class="requiredField"', 'class="blockLabel"'):
+            self.assertTrue(bit in lean_html, bit)
+        self.assertEqual(lean_html.count('class="errorField"'), html.count('class="errorField"'))
+        self.assertEqual(lean_html.count('class="formHint"'), html.count('class="formHint"'))
+        # MultiField fields keep their holder, hints are paragraphs
+        self.assertTrue('<div id="div_id_check_0" class="ctrlHolder checkbox">' in lean_html)
+        self.assertEqual(lean_html.count('<div'), html.count('<div') - 50)
+        self.assertTrue(len(lean_html.encode('utf-8')) < len(html.encode('utf-8')) * 0.6)
+
+        # The MultiField template includes the field one and is specialized like it
+        lean_context = Context({'uni_form_template_pack': 'uni_form_lean'})
+        self.assertEqual(get_static_field_attrs('uni_form_lean/multifield.html', lean_context),
+            get_static_field_attrs('uni_form_lean/field.html', lean_context))
+        self.assertTrue(get_static_field_attrs('uni_form_lean/multifield.html', lean_context) is not None)
+
+        # Render times are reported, best of several runs, and checked with a wide margin
+        def best_time(template_pack):
+            times = []
+            for run in range(5):
+                started = time.time()
+                for i in range(5):
+                    render(template_pack)
+                times.append((time.time() - started) / 5)
+            return min(times)
+
+        default_time, lean_time = best_time(None), best_time('uni_form_lean')
+        sys.stderr.write("\nlean pack: %.2f ms per render, default pack: %.2f ms per render " % (
+            lean_time * 1000, default_time * 1000))
+        self.assertTrue(lean_time < default_time * 2)
+
+    def test_helper_serialization(self):
+        form_helper = FormHelper()
+        form_helper.form_id = 'serialized'
+        form_helper.form_method = 'GET'
+        form_helper.form_style = 'inline'
+        form_helper.add_input(Submit('save', 'Save', css_class='primary'))
+        form_helper.add_layout(
+            Layout(
+                Fieldset(_('Contact details'),
+                    'email',
+                    Row('password1', 'password2', css_class='passwords'),
+                    css_id='contact',
+                ),
+                MultiField('Name', 'first_name', 'last_name', label_class='names'),
+                Conditional(is_company_form, Div('is_company', css_id='company')),
+                HTML('<p>{{ title }}</p>'),
+                ButtonHolder(Reset('reset', 'Reset')),
+            )
+        )
+
+        data = dumps_helper(form_helper)
+        self.assertTrue(', ' not in data and ': ' not in data)
+        self.assertEqual(simplejson.loads(data)['v'], 1)
+        self.assertTrue('"Contact details"' in data)
+        # Default attributes are not serialized
+        self.assertFalse('resetButton' in data)
+        self.assertTrue('"formRow passwords"' in data)
+
+        loaded_helper = loads_helper(data)
+        self.assertEqual(dumps_helper(loaded_helper), data)
+        self.assertEqual(loaded_helper.form_style, 'inlineLabels')
+
+        template = get_template_from_string(u"""
+            {% load uni_form_tags %}
+            {% uni_form form form_helper %}
+        """)
+        for form_data in ({}, {'is_company': 'on', 'email': 'invalid'}):
+            html = template.render(Context({'form': TestForm(form_data), 'form_helper': form_helper, 'title': 'Hi'}))
+            loaded_html = template.render(Context({'form': TestForm(form_data), 'form_helper': loaded_helper,
+                'title': 'Hi'}))
+            self.assertEqual(html, loaded_html)
+
+        descriptor = serialize_layout(Layout(
+            Deferred('profile', Fieldset('Shipping', 'carrier'), css_id='shipping'),
+            LargeChoiceField('city', 'cities', search_fields=('name__istartswith',), page_size=10),
+        ))
+        self.assertEqual(serialize_layout(load_layout(descriptor)), descriptor)
+        self.assertEqual(load_layout(descriptor).fields[1].search_fields, ['name__istartswith'])
+
+        self.assertRaises(SerializationError, serialize_layout,
+            Conditional(lambda form, context, user: True, 'email'))
+        self.assertRaises(SerializationError, loads_helper, '{"v":2}')
+        self.assertRaises(SerializationError, load_layout, ['Unknown', [], []])
+
+    def test_form_state_serialization(self):
+        form = TestForm({'email': 'test@example.com', 'first_name': 'Miguel', 'password1': 'a', 'password2': 'b'})
+        state = simplejson.loads(dumps_form_state(form))
+        self.assertEqual(state['values'], {'email': 'test@example.com', 'first_name': 'Miguel',
+            'is_company': False})
+        self.assertFalse('password1' in state['values'])
+        self.assertEqual(sorted(state['errors']), ['__all__', 'last_name'])
+        self.assertFalse('prefix' in state)
+
+        TestFormSet = formset_factory(TestForm, extra=2)
+        state = simplejson.loads(dumps_form_state(TestFormSet()))
+        self.assertEqual(state['prefix'], 'form')
+        self.assertEqual(state['management']['TOTAL_FORMS'], 2)
+        self.assertEqual(state['forms'], [{'prefix': 'form-0'}, {'prefix': 'form-1'}])
@@ -2,4 +2,13 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('',
     url(r'^simple/action/$', 'simpleAction', name = 'simpleAction'),
+    url(r'^uni_form/', include('uni_form.urls')),
+)
+
+# Pages driven by the load harness, see `uni_form.tests.loadtest`
+urlpatterns += patterns('uni_form.tests.views',
+    url(r'^loadtest/form/$', 'form_view', name='loadtest_form'),
+    url(r'^loadtest/filter/$', 'filter_view', name='loadtest_filter'),
+    url(r'^loadtest/layout/$', 'layout_view', name='loadtest_layout'),
+    url(r'^loadtest/formset/$', 'formset_view', name='loadtest_formset'),
 )
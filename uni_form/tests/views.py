@@ -0,0 +1,59 @@
+"""
+Views rendering representative forms, formsets and layouts, used by the load harness
+in `uni_form.tests.loadtest`.
+"""
+from django.forms.models import formset_factory
+from django.http import HttpResponse
+from django.template import RequestContext, Template
+
+from uni_form.helpers import FormHelper, Submit
+from uni_form.helpers import Layout, Fieldset, MultiField, Row, HTML, ButtonHolder, Div
+from uni_form.tests.tests import TestForm
+
+
+form_template = Template(u"""
+    {% load uni_form_tags %}
+    <html><body>{% uni_form form helper %}</body></html>
+""")
+
+filter_template = Template(u"""
+    {% load uni_form_tags %}
+    <html><body><form method="post" class="uniForm">{% csrf_token %}{{ form|as_uni_form }}</form></body></html>
+""")
+
+form_helper = FormHelper()
+form_helper.add_input(Submit('save', 'Save'))
+
+layout_helper = FormHelper()
+layout_helper.add_layout(
+    Layout(
+        Fieldset('{{ title }}',
+            'email',
+            Row('password1', 'password2'),
+        ),
+        MultiField('Company', 'is_company', css_id='company'),
+        Div('first_name', 'last_name', css_class='names'),
+        HTML('{% if forloop.first %}<p>First item</p>{% endif %}'),
+        ButtonHolder(Submit('save', 'Save')),
+    )
+)
+
+TestFormSet = formset_factory(TestForm, extra=10)
+
+
+def render(template, request, **kwargs):
+    return HttpResponse(template.render(RequestContext(request, kwargs)))
+
+def form_view(request):
+    return render(form_template, request, form=TestForm(request.POST or None), helper=form_helper)
+
+def filter_view(request):
+    return render(filter_template, request, form=TestForm(request.POST or None))
+
+def layout_view(request):
+    return render(form_template, request, form=TestForm(request.POST or None), helper=layout_helper,
+        title='Account')
+
+def formset_view(request):
+    return render(form_template, request, form=TestFormSet(request.POST or None), helper=layout_helper,
+        title='Item')
@@ -0,0 +1,133 @@
+"""
+Render traces in Chrome `trace_event` format, that can be opened in `chrome://tracing`
+or any compatible trace viewer.
+
+While a `TraceRecorder` is recording in the current thread, django-uni-form records
+nested spans for every `{% uni_form %}` render, layout object render, field render,
+template load and `Template()` compile. Spans are labelled with the node type and its
+legend, label, `css_id`, HTML code or field name.
+
+Set `UNIFORM_TRACE_DIR` to a directory for writing a trace file of every
+`{% uni_form %}` render into it. It is meant for debugging slow pages, don't leave it
+on in production.
+"""
+import os
+import thread
+import threading
+import time
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+
+
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, recorder, name, category, args):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = time.time()
+
+    def finish(self):
+        self.recorder.add(self, time.time())
+
+
+class TraceRecorder(object):
+    """
+    Records spans as complete (`"ph": "X"`) trace events, see `start_recording`.
+    """
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.tid = thread.get_ident()
+
+    def add(self, span, finished):
+        self.events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int(span.started * 1000000),
+            'dur': int((finished - span.started) * 1000000),
+            'pid': self.pid,
+            'tid': self.tid,
+            'args': span.args,
+        })
+
+    def to_json(self):
+        # Viewers nest spans by start time, parents have to come first
+        events = sorted(self.events, key=lambda event: (event['ts'], -event['dur']))
+        return simplejson.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def write(self, path):
+        trace_file = open(path, 'w')
+        try:
+            trace_file.write(self.to_json())
+        finally:
+            trace_file.close()
+
+
+def start_recording():
+    """
+    Returns a new `TraceRecorder`, recording spans in the current thread until
+    `stop_recording` is called.
+    """
+    recorder = _local.recorder = TraceRecorder()
+    return recorder
+
+def stop_recording():
+    _local.recorder = None
+
+def is_recording():
+    return getattr(_local, 'recorder', None) is not None
+
+def span(name, category, **args):
+    """
+    Returns a started `Span`, or None if nothing is being recorded. Callers `finish` it.
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return None
+    return Span(recorder, name, category, args)
+
+def describe_node(node):
+    """
+    Returns the span name and arguments for rendering layout object `node`.
+    """
+    args = {}
+    label = None
+    for attr in ('legend', 'label_html', 'css_id', 'html'):
+        value = getattr(node, attr, None)
+        if value:
+            value = force_unicode(value)
+            args[attr] = value
+            if label is None:
+                label = value
+
+    name = node.__class__.__name__
+    if label is not None:
+        if len(label) > 40:
+            label = label[:37] + u'...'
+        name = u'%s: %s' % (name, label)
+    return name, args
+
+
+def start_render_trace():
+    """
+    Starts recording a trace of a `{% uni_form %}` render if `UNIFORM_TRACE_DIR` is set
+    and nothing is being recorded already. Returns the recorder or None.
+    """
+    if getattr(settings, 'UNIFORM_TRACE_DIR', None) and not is_recording():
+        return start_recording()
+    return None
+
+def finish_render_trace(recorder, form_name):
+    """
+    Stops `recorder`, writing its trace into `UNIFORM_TRACE_DIR`.
+    """
+    stop_recording()
+    file_name = 'uni_form-%s-%d.json' % (form_name, int(time.time() * 1000000))
+    recorder.write(os.path.join(settings.UNIFORM_TRACE_DIR, file_name))
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('uni_form.views',
+    url(r'^deferred/(?P<source>[\w-]+)/(?P<key>[\w-]+)/$', 'render_deferred', name='uni_form_deferred'),
+    url(r'^choices/(?P<source>[\w-]+)/(?P<field>\w+)/$', 'render_choices', name='uni_form_choices'),
+)
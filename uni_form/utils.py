@@ -1,15 +1,111 @@
 import logging
+import re
 import sys
 
 from django.conf import settings
+from django.core.cache import get_cache
 from django.forms.forms import BoundField
-from django.template import Context
+from django.forms.widgets import CheckboxInput
+from django.template import Node, Template, TemplateDoesNotExist, Variable, VariableDoesNotExist, FilterExpression
+from django.template import TextNode, VariableNode, defaultfilters
+from django.template.defaulttags import (AutoEscapeControlNode, CommentNode, FirstOfNode, ForNode,
+    IfEqualNode, IfNode, LoadNode, SpacelessNode, WithNode)
+from django.template.smartif import TokenBase
 from django.template.loader import get_template
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
+from uni_form import fragments, metrics, stats, trace
+from uni_form.templatetags.uni_form_field import FieldDescriptor
+
+
+# Templates by name, filled on demand by `get_cached_template`. This way we avoid
+# loading templates, like the default field template, every time we render them
+templates_cache = {}
+
+def get_cached_template(template_name):
+    """
+    Returns template `template_name`, loading it only the first time. In DEBUG mode it
+    is loaded every time, so that template changes show up without restarting.
+    """
+    if not settings.DEBUG:
+        try:
+            template = templates_cache[template_name]
+            stats.incr('template_cache_hits')
+            return template
+        except KeyError:
+            pass
+
+    stats.incr('template_loads')
+    span = trace.span(u'load: %s' % template_name, 'template')
+    template = templates_cache[template_name] = get_template(template_name)
+    if span is not None:
+        span.finish()
+    return template
+
+# (template pack, template name) -> name of the template used, filled on demand by
+# `get_pack_template_name`
+pack_templates = {}
+
+def get_template_pack(context=None):
+    """
+    Returns the template pack in use: `uni_form_template_pack` in `context`, set by
+    `FormHelper.template_pack` or by your views, or `UNIFORM_TEMPLATE_PACK` setting.
+    """
+    pack = None
+    if context is not None:
+        pack = context.get('uni_form_template_pack')
+    return pack or getattr(settings, 'UNIFORM_TEMPLATE_PACK', 'uni_form')
+
+def get_pack_template_name(template_name, context=None):
+    """
+    Returns the name of the template the template pack in use has for `template_name`,
+    replacing its `uni_form` directory by the pack one. If the pack doesn't have it,
+    `template_name` is returned. Resolutions are kept unless in DEBUG mode.
+    """
+    pack = get_template_pack(context)
+    if pack == 'uni_form' or not template_name.startswith('uni_form/'):
+        return template_name
+
+    key = (pack, template_name)
+    if not settings.DEBUG:
+        try:
+            return pack_templates[key]
+        except KeyError:
+            pass
+
+    name = pack + template_name[len('uni_form'):]
+    try:
+        get_cached_template(name)
+    except TemplateDoesNotExist:
+        name = template_name
+    pack_templates[key] = name
+    return name
+
+def get_pack_template(template_name, context=None):
+    """
+    Returns the template of the template pack in use for `template_name`.
+    """
+    return get_cached_template(get_pack_template_name(template_name, context))
+
+def render_to_string(template_name, dictionary, context):
+    """
+    Like Django's `render_to_string`, pushing `dictionary` into `context`, but using
+    `get_cached_template` so that layout object templates are loaded once, from the
+    template pack in use.
+    """
+    template = get_pack_template(template_name, context)
+    context.update(dictionary)
+    try:
+        return template.render(context)
+    finally:
+        context.pop()
 
-# Global field template, default template used for rendering a field. This way we avoid 
-# loading the template every time render_field is called without a template
-default_field_template = get_template("uni_form/field.html")
 
 def render_field(field, form, form_style, context, template=None, labelclass=None, layout_object=None):
     """
@@ -32,9 +128,19 @@ def render_field(field, form, form_style, context, template=None, labelclass=Non
         We use it to store its bound fields in a list called `layout_object.bound_fields`
     """
     FAIL_SILENTLY = getattr(settings, 'UNIFORM_FAIL_SILENTLY', True)
+    timer = metrics.start('render_field')
 
     if hasattr(field, 'render'):
-        return field.render(form, form_style, context)
+        span = None
+        if trace.is_recording():
+            name, args = trace.describe_node(field)
+            span = trace.span(name, 'layout', **args)
+        html = field.render(form, form_style, context)
+        if span is not None:
+            span.finish()
+        if timer is not None:
+            timer.stop(node=field.__class__.__name__, **metrics.get_tags(form))
+        return html
     else:
         # This allows fields to be unicode strings, always they don't use non ASCII
         try:
@@ -68,17 +174,523 @@ def render_field(field, form, form_style, context, template=None, labelclass=Non
     if field_instance is None:
         html = ''
     else:
-        bound_field = BoundField(form, field_instance, field)
+        bound_field = FieldDescriptor(BoundField(form, field_instance, field))
 
         if template is None:
-            template = default_field_template
-        else:
-            template = get_template(template)
+            template = 'uni_form/field.html'
+        template = get_pack_template_name(template, context)
 
         # We save the Layout object's bound fields in the layout object's `bound_fields` list
         if layout_object is not None:
             layout_object.bound_fields.append(bound_field) 
         
-        html = template.render(Context({'field': bound_field, 'labelclass': labelclass}))
+        span = trace.span(u'field: %s' % field, 'field', field=field, template=template)
+        memo = get_field_memo()
+        html = memo_key = None
+        if memo is not None:
+            memo_key = get_field_memo_key(template, bound_field, form_style, context)
+            if memo_key is not None:
+                html = memo.get(memo_key)
 
+        if html is not None:
+            html = mark_safe(html)
+            if span is not None:
+                span.finish()
+        else:
+            context.update({'field': bound_field, 'labelclass': labelclass})
+            try:
+                html = render_field_template(template, bound_field, form, form_style, context)
+            finally:
+                context.pop()
+                if span is not None:
+                    span.finish()
+            if memo_key is not None:
+                memo.set(memo_key, html)
+
+    if timer is not None:
+        timer.stop(node='field', **metrics.get_tags(form))
     return html
+
+
+# Markers standing for the parts of a field template output that change between renders
+WIDGET_MARKER = u'\x00uni_form:widget_html\x00'
+FIELD_MARKER = u'\x00uni_form:field\x00'
+markers_re = re.compile(u'(\x00uni_form:\\w+\x00)')
+
+# Field attributes that don't change between renders of a form class field, unless the
+# form instance changes the field. Values are part of the specialization keys.
+STATIC_FIELD_ATTRS = frozenset(['auto_id', 'is_hidden', 'label', 'help_text', 'required', 'is_checkbox',
+    'holder_class', 'input_class', 'css_classes', 'widget_class', 'name', 'html_name'])
+
+# Template pack and field template name -> static field attributes it uses, or None if it
+# can't be specialized
+specializable_templates = {}
+
+
+
+class FieldProbe(FieldDescriptor):
+    """
+    Field descriptor holding static values of a real one and markers for the rest,
+    used for rendering a field template partially.
+    """
+    def __init__(self, field, attrs):
+        for attr in attrs:
+            setattr(self, attr, getattr(field, attr))
+        self.errors = ()
+        self._widget_html = mark_safe(WIDGET_MARKER)
+
+    def __unicode__(self):
+        return mark_safe(FIELD_MARKER)
+
+
+def get_static_field_attrs(template_name, context=None):
+    """
+    Returns the static field attributes that field template `template_name` uses, with
+    the templates it includes from the template pack in use, or None if its output may
+    depend on anything else.
+    """
+    key = (get_template_pack(context), template_name)
+    try:
+        return specializable_templates[key]
+    except KeyError:
+        pass
+
+    # Imported here, the tags module imports this one
+    from uni_form.templatetags.uni_form_tags import PackIncludeNode
+
+    def follow(node):
+        if isinstance(node, PackIncludeNode):
+            return get_pack_template(node.template_name, context).nodelist
+        return None
+
+    attrs = None
+    lookups = get_template_lookups(get_cached_template(template_name).nodelist, follow)
+    if lookups is not None and lookups[1] <= set(['safe', 'field_descriptor']):
+        attrs = set()
+        for bits in lookups[0]:
+            if bits[0] != 'field' or len(bits) > 2:
+                attrs = None
+                break
+            if len(bits) == 2 and bits[1] not in ('errors', 'widget_html'):
+                if bits[1] not in STATIC_FIELD_ATTRS:
+                    attrs = None
+                    break
+                attrs.add(bits[1])
+
+    if attrs is not None:
+        attrs = tuple(sorted(attrs))
+    specializable_templates[key] = attrs
+    return attrs
+
+def render_field_template(template_name, field, form, form_style, context):
+    """
+    Renders `field` descriptor, that has been pushed into `context`, using `template_name`.
+
+    Field templates are partially evaluated per form class, field and values of the static
+    field attributes they use: everything but the widget is rendered once, and later on only
+    the widget is rendered and put in place. It's done only for templates that use nothing
+    but field attributes, and when the field has no errors. Outputs are kept apart by the
+    template pack in use, the autoescaping of `context` and the active language too.
+    """
+    attrs = None
+    if not settings.DEBUG and not field.errors:
+        attrs = get_static_field_attrs(template_name, context)
+
+    if attrs is None:
+        return get_cached_template(template_name).render(context)
+
+    values = []
+    for attr in attrs:
+        value = getattr(field, attr)
+        if isinstance(value, Promise):
+            value = force_unicode(value)
+        values.append(value)
+    key = ('field', template_name, form_style, form.__class__, field.name, tuple(values),
+        get_template_pack(context), context.autoescape, get_language())
+
+    # The template output is kept in the fragment store split in segments: static
+    # parts at even positions and markers in between
+    store = fragments.get_store()
+    segments = store.get(key)
+    if segments is None:
+        context.update({'field': FieldProbe(field, attrs)})
+        try:
+            output = get_cached_template(template_name).render(context)
+        finally:
+            context.pop()
+        segments = tuple(markers_re.split(output))
+        store.set(key, segments)
+
+    html = []
+    for position, segment in enumerate(segments):
+        if position % 2 == 0:
+            html.append(segment)
+        elif segment == WIDGET_MARKER:
+            html.append(field.widget_html)
+        else:
+            html.append(unicode(field))
+
+    return mark_safe(u''.join(html))
+
+
+# `UNIFORM_FIELD_MEMO` cache name -> cache, filled on demand by `get_field_memo`
+field_memo_caches = {}
+
+def get_field_memo():
+    """
+    Returns where rendered fields are memoized, set in `UNIFORM_FIELD_MEMO`: 'fragments'
+    for the fragment store in use, or the name of a cache in `CACHES` settings. Returns
+    None if it is not set or in DEBUG mode.
+    """
+    name = getattr(settings, 'UNIFORM_FIELD_MEMO', None)
+    if not name or settings.DEBUG:
+        return None
+    if name == 'fragments':
+        return fragments.get_store()
+
+    try:
+        return field_memo_caches[name]
+    except KeyError:
+        cache = field_memo_caches[name] = get_cache(name)
+        return cache
+
+def get_memo_value(value):
+    """
+    Returns `value` as unicode strings, numbers, booleans, None and lists of them, so that
+    its repr is the same in every process and language.
+    """
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [get_memo_value(item) for item in value]
+    return force_unicode(value)
+
+# Memo states of static choices, by id of the choices list and language. Entries hold the
+# list, so that its id can't be reused by another one while they are kept
+choices_memo_states = {}
+MAX_CHOICES_MEMO_STATES = 1000
+
+def get_choices_memo_state(choices):
+    """
+    Returns a hash of static `choices`, with their labels translated, computed once per
+    choices list and language. Returns None for any other choices, like the ones of model
+    choice fields, as it would mean running their queries.
+    """
+    if not isinstance(choices, (list, tuple)):
+        return None
+
+    key = (id(choices), get_language())
+    entry = choices_memo_states.get(key)
+    if entry is None or entry[0] is not choices or entry[1] != len(choices):
+        if len(choices_memo_states) >= MAX_CHOICES_MEMO_STATES:
+            choices_memo_states.clear()
+        state = md5_constructor(repr(get_memo_value(list(choices)))).hexdigest()
+        entry = choices_memo_states[key] = (choices, len(choices), state)
+    return entry[2]
+
+def get_widget_memo_state(widget, value):
+    """
+    Returns the state of `widget` its output depends on: class, attributes, choices with
+    their labels translated, localization, the settings of some built-in widgets and the
+    state of the widgets within. Returns None if it can't be computed cheaply.
+    """
+    state = ['%s.%s' % (widget.__class__.__module__, widget.__class__.__name__),
+        sorted([(name, get_memo_value(attr)) for name, attr in widget.attrs.items()]),
+        widget.is_localized]
+    for attr in ('input_type', 'format', 'render_value'):
+        state.append(get_memo_value(getattr(widget, attr, None)))
+    if isinstance(widget, CheckboxInput):
+        state.append(bool(widget.check_test(value)))
+    if hasattr(widget, 'choices'):
+        choices_state = get_choices_memo_state(widget.choices)
+        if choices_state is None:
+            return None
+        state.append(choices_state)
+    for subwidget in getattr(widget, 'widgets', ()):
+        subwidget_state = get_widget_memo_state(subwidget, None)
+        if subwidget_state is None:
+            return None
+        state.append(subwidget_state)
+    return state
+
+def get_field_memo_key(template_name, field, form_style, context):
+    """
+    Returns the memo key of `field` descriptor rendered with `template_name` in `context`,
+    a hash of everything its output depends on: name, label, help text, errors, value,
+    widget state, template, template pack, `form_style`, autoescaping, active language and
+    localization settings.
+
+    Returns None for templates that use anything but field attributes and for widgets
+    whose state isn't cheap to compute, like model choice fields ones, as their output
+    can't be memoized.
+    """
+    if get_static_field_attrs(template_name, context) is None:
+        return None
+
+    bound_field = field.bound_field
+    value = bound_field.value()
+    widget_state = get_widget_memo_state(bound_field.field.widget, value)
+    if widget_state is None:
+        return None
+
+    initial = None
+    if bound_field.field.show_hidden_initial:
+        initial = bound_field.form.initial.get(bound_field.name, bound_field.field.initial)
+    bits = (template_name, get_template_pack(context), form_style, context.autoescape, get_language(),
+        settings.USE_L10N, field.html_name, field.auto_id, force_unicode(field.label),
+        force_unicode(field.help_text), field.required, field.css_classes,
+        [force_unicode(error) for error in field.errors], get_memo_value(value), get_memo_value(initial),
+        widget_state)
+    return 'uni_form.field.%s' % md5_constructor(repr(bits)).hexdigest()
+
+
+# Markup emitted in place of per-request values when a form is rendered with placeholders.
+# Markers are signed, so unescaped content, like `|safe` labels or `HTML` contents, can't
+# make `fill_placeholders` print other context values: only the ones of `Placeholder`
+# objects, pushed for the CSRF token and `FormHelper.placeholders` names, are filled.
+PLACEHOLDER_FORMAT = u'<!--uni_form:%s:%s-->'
+placeholder_re = re.compile(r'<!--uni_form:([\w.]+):([0-9a-f]+)-->')
+
+def get_placeholder_signature(name):
+    return salted_hmac('uni_form.utils.Placeholder', name).hexdigest()[:16]
+
+class Placeholder(object):
+    """
+    Stands in for a per-request context value while a form is rendered with
+    `FormHelper.placeholders` set. It renders to a marker that `fill_placeholders`
+    substitutes later on. Lookups are chained, so `{{ user.username }}` renders to
+    the marker of `user.username`.
+
+    Placeholders are meant to be printed, using them in `{% if %}` or passing them
+    through filters will not do what you expect.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, key):
+        return Placeholder('%s.%s' % (self.name, key))
+
+    def __unicode__(self):
+        return mark_safe(PLACEHOLDER_FORMAT % (self.name, get_placeholder_signature(self.name)))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def get_placeholders(names):
+    """
+    Returns a dictionary of `Placeholder` objects for the CSRF token and `names`,
+    ready to be pushed into a context.
+    """
+    placeholders = {'csrf_token': Placeholder('csrf_token')}
+    for name in names:
+        placeholders[name] = Placeholder(name)
+
+    return placeholders
+
+def fill_placeholders(html, context):
+    """
+    Second phase of placeholder rendering. Substitutes every placeholder in `html`
+    with its value resolved from `context`, which can be a `Context` or a dictionary.
+    Values are escaped unless they are marked as safe. Unresolved values are left
+    empty. Markers without a valid signature are left untouched.
+    """
+    def replace(match):
+        name, signature = match.groups()
+        if not constant_time_compare(signature, get_placeholder_signature(name)):
+            return match.group(0)
+        try:
+            value = Variable(name).resolve(context)
+        except VariableDoesNotExist:
+            value = u''
+        return conditional_escape(value)
+
+    return mark_safe(placeholder_re.sub(replace, html))
+
+
+# Template nodes whose output depends only on the variables they use
+analysable_nodes = (TextNode, VariableNode, AutoEscapeControlNode, CommentNode, FirstOfNode, ForNode,
+    IfEqualNode, IfNode, LoadNode, SpacelessNode, WithNode)
+
+class NotAnalysable(Exception):
+    pass
+
+def get_template_lookups(nodelist, follow=None):
+    """
+    Returns a tuple with the set of variable lookups, as tuples of bits like `('user', 'username')`,
+    and the set of filter names that a template `nodelist` uses. `{% for %}` loop variables are
+    left out.
+
+    Returns None if it can't tell, because the template uses tags whose output could depend on
+    something else, like `{% cycle %}` or custom tags. `follow` can tell about other tags: it's
+    called with their nodes and returns the nodelist to analyse in their place, like the one of
+    an included template, or None.
+    """
+    lookups, filters = set(), set()
+    try:
+        _collect_lookups(nodelist, frozenset(), lookups, filters, follow)
+    except NotAnalysable:
+        return None
+
+    return lookups, filters
+
+def _collect_lookups(obj, local_names, lookups, filters, follow=None):
+    if isinstance(obj, FilterExpression):
+        _collect_lookups(obj.var, local_names, lookups, filters, follow)
+        for func, args in obj.filters:
+            filters.add(func.__name__)
+            for lookup, arg in args:
+                if lookup:
+                    _collect_lookups(arg, local_names, lookups, filters, follow)
+
+    elif isinstance(obj, Variable):
+        if obj.lookups is None:
+            return
+        if 'parentloop' in obj.lookups:
+            raise NotAnalysable
+        if obj.lookups[0] not in local_names:
+            lookups.add(tuple(obj.lookups))
+
+    elif isinstance(obj, Node):
+        if not isinstance(obj, analysable_nodes):
+            nodelist = None
+            if follow is not None:
+                nodelist = follow(obj)
+            if nodelist is None:
+                raise NotAnalysable
+            _collect_lookups(nodelist, local_names, lookups, filters, follow)
+
+        # `{% with %}` names are not taken as local, they are mostly aliases like
+        # `{% with field|field_descriptor as field %}`
+        elif isinstance(obj, ForNode):
+            _collect_lookups(obj.sequence, local_names, lookups, filters, follow)
+            loop_names = local_names.union(obj.loopvars).union(['forloop'])
+            _collect_lookups(obj.nodelist_loop, loop_names, lookups, filters, follow)
+            _collect_lookups(obj.nodelist_empty, local_names, lookups, filters, follow)
+        else:
+            _collect_lookups(vars(obj), local_names, lookups, filters, follow)
+
+    elif isinstance(obj, TokenBase):
+        # `{% if %}` conditions
+        _collect_lookups(vars(obj), local_names, lookups, filters, follow)
+
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _collect_lookups(value, local_names, lookups, filters, follow)
+
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _collect_lookups(item, local_names, lookups, filters, follow)
+
+
+class TemplateSnippet(object):
+    """
+    A piece of template code in a layout, like `HTML` contents or `Fieldset` legends. It is
+    compiled once, and classified by the variables it uses in `dependency`:
+
+        * `'constant'`: It doesn't use `forloop`, so all forms of a formset render it the same.
+        * `'forloop'`: It only uses `forloop.first` and `forloop.last`, so formset forms render
+          one out of a few variants.
+        * `'dynamic'`: Anything else, it has to be rendered every time.
+
+    Only snippets made of variable lookups, built-in filters and tags like `{% if %}` can be
+    constant or forloop, and while rendering, only if none of their lookups goes through a
+    callable, as calling it could have side effects.
+
+    When rendering a formset, `{% uni_form %}` puts a `render_cache` in its `forloop`, where
+    constant and forloop snippets keep their output, so they are rendered once per formset.
+    """
+    def __init__(self, source):
+        span = trace.span(u'compile', 'template', source=source)
+        self.template = Template(source)
+        stats.incr('compilations')
+        if span is not None:
+            span.finish()
+
+        self.dependency = 'dynamic'
+        self.lookups = ()
+        lookups = get_template_lookups(self.template.nodelist)
+        if lookups is not None and lookups[1] <= pure_filters and \
+                not self.template.nodelist.get_nodes_by_type(ForNode):
+            forloop_lookups = [bits[1:] for bits in lookups[0] if bits[0] == 'forloop']
+            if not forloop_lookups:
+                self.dependency = 'constant'
+            elif all(bits in (('first',), ('last',)) for bits in forloop_lookups):
+                self.dependency = 'forloop'
+            self.lookups = [bits for bits in lookups[0] if bits[0] != 'forloop']
+
+    def render(self, context):
+        if self.dependency == 'dynamic':
+            return self.template.render(context)
+
+        forloop = context.get('forloop')
+        render_cache = getattr(forloop, 'render_cache', None)
+        if render_cache is None:
+            return self.template.render(context)
+
+        # Whether the snippet lookups are free of calls is checked once per formset
+        pure = render_cache.get(self)
+        if pure is None:
+            pure = render_cache[self] = all(is_pure_lookup(bits, context) for bits in self.lookups)
+        if not pure:
+            return self.template.render(context)
+
+        if self.dependency == 'constant':
+            key = (self,)
+        else:
+            key = (self, forloop.first, forloop.last)
+
+        try:
+            return render_cache[key]
+        except KeyError:
+            html = render_cache[key] = self.template.render(context)
+            return html
+
+
+# Names of the built-in filters, which have no side effects
+pure_filters = frozenset([func.__name__ for func in defaultfilters.register.filters.values()])
+
+def is_pure_lookup(bits, context):
+    """
+    Returns whether resolving the variable lookup `bits` in `context` calls nothing,
+    following Django's lookup order: dictionary, attribute and list index.
+    """
+    try:
+        current = context[bits[0]]
+    except KeyError:
+        return True
+
+    for bit in bits[1:]:
+        if callable(current):
+            return False
+        try:
+            current = current[bit]
+        except (TypeError, AttributeError, KeyError, ValueError, IndexError):
+            try:
+                current = getattr(current, bit)
+            except AttributeError:
+                try:
+                    current = current[int(bit)]
+                except (IndexError, ValueError, KeyError, TypeError):
+                    return True
+    return not callable(current)
+
+
+# Compiled snippets by source text, filled on demand by `get_snippet`
+snippets_cache = {}
+SNIPPETS_CACHE_SIZE = 1000
+
+def get_snippet(source):
+    """
+    Returns the `TemplateSnippet` for `source`, compiling it only the first time. `source`
+    can be a lazy translation, it's translated to the active language and every language
+    gets its own compiled snippet, so layouts can be built once and used in every language.
+    """
+    source = force_unicode(source)
+    try:
+        return snippets_cache[source]
+    except KeyError:
+        if len(snippets_cache) >= SNIPPETS_CACHE_SIZE:
+            snippets_cache.clear()
+        snippet = snippets_cache[source] = TemplateSnippet(source)
+        return snippet
@@ -0,0 +1,113 @@
+import operator
+
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.template import RequestContext
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+
+from uni_form.layout import Deferred, LargeChoiceField, iter_choices
+
+
+# Name -> factory returning the form and helper `Deferred` layout objects belong to
+deferred_sources = {}
+
+def register_deferred(name, factory):
+    """
+    Registers `factory` as the source of the deferred layout objects created with
+    `Deferred(name, ...)`. It is called with the request and returns a tuple with the
+    form and the helper. The request query string is the one of the page where the
+    form was rendered, so factories can use it for getting the instance to edit::
+
+        def profile_form(request):
+            profile = get_object_or_404(Profile, pk=request.GET.get('profile'))
+            return ProfileForm(instance=profile), ProfileForm.helper
+
+        register_deferred('profile', profile_form)
+    """
+    deferred_sources[name] = factory
+
+
+def render_deferred(request, source, key):
+    """
+    Renders the layout object deferred by the `Deferred` object with `css_id` `key` in
+    the layout of the form and helper returned by the factory registered as `source`.
+    """
+    try:
+        factory = deferred_sources[source]
+    except KeyError:
+        raise Http404("No deferred source '%s'" % source)
+
+    form, helper = factory(request)
+    try:
+        deferred = helper.layout.get_node(key)
+    except KeyError:
+        deferred = None
+    if not isinstance(deferred, Deferred):
+        raise Http404("No deferred layout object '%s' in '%s'" % (key, source))
+
+    form.rendered_fields = []
+    html = deferred.render_node(form, helper.form_style, RequestContext(request))
+    return HttpResponse(html)
+
+
+def get_large_choice_field(layout, field):
+    """
+    Returns the `LargeChoiceField` layout object for `field` in `layout`, or None.
+    """
+    nodes = list(layout.fields)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, LargeChoiceField) and node.fields[0] == field:
+            return node
+        nodes.extend(getattr(node, 'fields', ()))
+
+def render_choices(request, source, field):
+    """
+    Returns a page of the choices of a field rendered with `LargeChoiceField`, as JSON::
+
+        {"results": [{"value": "1", "label": "Aachen"}, ...], "page": 1, "has_next": true}
+
+    `q` GET parameter filters choices, `page` is the page number, starting at 1.
+    """
+    try:
+        factory = deferred_sources[source]
+    except KeyError:
+        raise Http404("No deferred source '%s'" % source)
+
+    form, helper = factory(request)
+    node = get_large_choice_field(helper.layout, field)
+    if node is None:
+        raise Http404("No large choice field '%s' in '%s'" % (field, source))
+
+    form_field = form.fields[field]
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    start = (page - 1) * node.page_size
+    end = start + node.page_size + 1
+
+    if hasattr(form_field, 'queryset') and (node.search_fields or not query):
+        queryset = form_field.queryset
+        if query:
+            queryset = queryset.filter(reduce(operator.or_,
+                [Q(**{lookup: query}) for lookup in node.search_fields]))
+        choices = [form_field.choices.choice(instance) for instance in queryset[start:end]]
+    else:
+        choices = []
+        query = query.lower()
+        for value, label in iter_choices(form_field.choices):
+            label = force_unicode(label)
+            if value in (None, u'') or (query and query not in label.lower()):
+                continue
+            choices.append((value, label))
+            if len(choices) == end:
+                break
+        choices = choices[start:end]
+
+    results = [{'value': force_unicode(value), 'label': force_unicode(label)}
+        for value, label in choices[:node.page_size]]
+    data = {'results': results, 'page': page, 'has_next': len(choices) > node.page_size}
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')